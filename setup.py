@@ -4,26 +4,21 @@ Copyright 2017, Daniel Newman, All rights reserved.
 """
 
 """
-Sets up the database for use with ShopTracker
-"""
-import MySQLdb as mysql
-import config
+Sets up the database for use with ShopTracker, using the storage backend selected in config.py
 
-def main():
-    try:
-        con = mysql.connect(config.db_host, config.db_user, config.db_password, config.db_name)
-        cur = con.cursor()
+python setup.py           drops and recreates all tables, then applies every migration
+python setup.py migrate   upgrades an existing database in place by applying pending migrations
+"""
+import hashlib
+import sys
 
-        # Drop tables
-        cur.execute("DROP TABLE IF EXISTS `products_collections`;")
-        cur.execute("DROP TABLE IF EXISTS `options_products`;")
-        cur.execute("DROP TABLE IF EXISTS `products`; ")
-        cur.execute("DROP TABLE IF EXISTS `collections`;")
-        cur.execute("DROP TABLE IF EXISTS `attributes`;")
-        cur.execute("DROP TABLE IF EXISTS `options`;")
+import storage
 
+# Base tables for each backend, migrations are applied on top of these.
+tables = {
+    'mysql' : [
         # Create products table
-        cur.execute("""
+        """
         CREATE TABLE `products`  (
             `products_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
             `products_handle` varchar(512) NOT NULL DEFAULT '',
@@ -41,30 +36,30 @@ def main():
             `products_g_gender` varchar(1024) NULL DEFAULT '',
             PRIMARY KEY (`products_id`)
         );
-        """)
+        """,
 
         # Create collections table
-        cur.execute("""
+        """
         CREATE TABLE `collections`  (
             `collections_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
             `collections_handle` varchar(512) NOT NULL DEFAULT '',
             `collections_title` varchar(512) NOT NULL DEFAULT '',
             PRIMARY KEY (`collections_id`)
         );
-        """) 
+        """,
 
         # Create options table
-        cur.execute("""
+        """
         CREATE TABLE `options`  (
             `options_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
             `options_handle` varchar(512) NOT NULL DEFAULT '',
             `options_title` varchar(512) NOT NULL DEFAULT '',
             PRIMARY KEY (`options_id`)
         );
-        """)
+        """,
 
         # Create attributes table, each row consist of an attribute and its associated options
-        cur.execute("""
+        """
         CREATE TABLE `attributes`  (
             `attributes_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
             `options_id` int(10) unsigned NOT NULL,
@@ -73,10 +68,10 @@ def main():
         FOREIGN KEY (options_id) REFERENCES options (options_id)
           ON UPDATE CASCADE ON DELETE CASCADE
         );
-        """)
+        """,
 
         # Create options_product table, which associates options with products
-        cur.execute("""
+        """
         CREATE TABLE `options_products`  (
             `options_id` int(10) unsigned NOT NULL,
             `products_id` int(10) unsigned NOT NULL,
@@ -86,10 +81,10 @@ def main():
         FOREIGN KEY (products_id) REFERENCES products (products_id)
           ON UPDATE CASCADE ON DELETE CASCADE
         );
-        """)
+        """,
 
         # Create products_collections table, which associates products with collections
-        cur.execute("""
+        """
         CREATE TABLE `products_collections`  (
             `products_id` int(10) unsigned NOT NULL,
             `collections_id` int(10) unsigned NOT NULL,
@@ -99,10 +94,330 @@ def main():
         FOREIGN KEY (collections_id) REFERENCES collections (collections_id)
           ON UPDATE CASCADE ON DELETE CASCADE
         );
-        """)
+        """,
+    ],
+
+    # SQLite can't auto increment part of a composite key, so attributes_id alone is the attributes primary key
+    'sqlite' : [
+        """
+        CREATE TABLE `products`  (
+            `products_id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `products_handle` varchar(512) NOT NULL DEFAULT '',
+            `products_title` varchar(512) NOT NULL DEFAULT '',
+            `products_price` decimal(13,2) NULL DEFAULT '0',
+            `products_desc` TEXT NULL,
+            `products_vendor` varchar(512) NULL DEFAULT '',
+            `products_sku` varchar(512) NULL DEFAULT '',
+            `products_tags` varchar(2096) NULL DEFAULT '',
+            `products_url` varchar(512) NULL DEFAULT '',
+            `products_img_url` varchar(512) NULL DEFAULT '',
+            `products_g_age_group` varchar(1024) NULL DEFAULT '',
+            `products_g_color` varchar(1024) NULL DEFAULT '',
+            `products_g_product_category` varchar(1024) NULL DEFAULT '',
+            `products_g_gender` varchar(1024) NULL DEFAULT ''
+        );
+        """,
+        """
+        CREATE TABLE `collections`  (
+            `collections_id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `collections_handle` varchar(512) NOT NULL DEFAULT '',
+            `collections_title` varchar(512) NOT NULL DEFAULT ''
+        );
+        """,
+        """
+        CREATE TABLE `options`  (
+            `options_id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `options_handle` varchar(512) NOT NULL DEFAULT '',
+            `options_title` varchar(512) NOT NULL DEFAULT ''
+        );
+        """,
+        """
+        CREATE TABLE `attributes`  (
+            `attributes_id` INTEGER PRIMARY KEY AUTOINCREMENT,
+            `options_id` INTEGER NOT NULL,
+            `attributes_title` varchar(512) NOT NULL DEFAULT '',
+        FOREIGN KEY (options_id) REFERENCES options (options_id)
+          ON UPDATE CASCADE ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE `options_products`  (
+            `options_id` INTEGER NOT NULL,
+            `products_id` INTEGER NOT NULL,
+            PRIMARY KEY (`options_id`,`products_id`),
+        FOREIGN KEY (options_id) REFERENCES options (options_id)
+          ON UPDATE CASCADE ON DELETE CASCADE,
+        FOREIGN KEY (products_id) REFERENCES products (products_id)
+          ON UPDATE CASCADE ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE `products_collections`  (
+            `products_id` INTEGER NOT NULL,
+            `collections_id` INTEGER NOT NULL,
+            PRIMARY KEY (`products_id`,`collections_id`),
+        FOREIGN KEY (products_id) REFERENCES products (products_id)
+          ON UPDATE CASCADE ON DELETE CASCADE,
+        FOREIGN KEY (collections_id) REFERENCES collections (collections_id)
+          ON UPDATE CASCADE ON DELETE CASCADE
+        );
+        """,
+    ],
+}
+
+# Tables in the order they're dropped, tables added by migrations come first since they reference the base tables
+drop_order = ['schema_version', 'product_tags', 'products_collections', 'options_products', 'option_sets_options', 'products', 'option_sets', 'collections', 'attributes', 'options']
+
+schema_version_table = {
+    'mysql' : """
+    CREATE TABLE IF NOT EXISTS `schema_version`  (
+        `version` int(10) unsigned NOT NULL,
+        `description` varchar(512) NOT NULL DEFAULT '',
+        `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (`version`)
+    );
+    """,
+    'sqlite' : """
+    CREATE TABLE IF NOT EXISTS `schema_version`  (
+        `version` INTEGER NOT NULL PRIMARY KEY,
+        `description` varchar(512) NOT NULL DEFAULT '',
+        `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+}
+
+def backfill_options_fingerprint(cur, backend):
+    """
+    Fills options_fingerprint for existing options, computed like Option.get_fingerprint.
+    Duplicate options left over from before fingerprinting are merged into the lowest id
+    """
+    cur.execute("SELECT o.options_id, o.options_handle, a.attributes_title FROM options AS o "
+                "LEFT JOIN attributes AS a ON a.options_id = o.options_id ORDER BY o.options_id;")
+    options = {}
+    for options_id, handle, attribute in cur.fetchall():
+        handle, attributes = options.setdefault(options_id, (handle, []))
+        if attribute is not None:
+            attributes.append(attribute)
+
+    kept = {}
+    for options_id, (handle, attributes) in sorted(options.items()):
+        fingerprint = hashlib.sha1('\n'.join([handle] + sorted(attributes)).encode('utf-8')).hexdigest()
+        if fingerprint in kept:
+            cur.execute("%s INTO options_products (options_id, products_id) SELECT %%s, products_id FROM options_products WHERE options_id = %%s;" %(backend.insert_ignore), (kept[fingerprint], options_id))
+            cur.execute("DELETE FROM options_products WHERE options_id = %s;", (options_id,))
+            cur.execute("DELETE FROM attributes WHERE options_id = %s;", (options_id,))
+            cur.execute("DELETE FROM options WHERE options_id = %s;", (options_id,))
+        else:
+            kept[fingerprint] = options_id
+            cur.execute("UPDATE options SET options_fingerprint = %s WHERE options_id = %s;", (fingerprint, options_id))
+
+def get_option_set_fingerprint(option_ids):
+    "Computed like OptionSet.get_fingerprint"
+    canonical = ','.join(str(option_id) for option_id in sorted(set(option_ids)))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def backfill_option_sets(cur, backend):
+    "Moves each product's rows in options_products into a shared option set, referenced by products.option_sets_id"
+    cur.execute("SELECT products_id, options_id FROM options_products ORDER BY products_id, options_id;")
+    product_options = {}
+    for products_id, options_id in cur.fetchall():
+        product_options.setdefault(products_id, []).append(options_id)
+
+    option_sets = {}
+    for products_id, option_ids in product_options.items():
+        fingerprint = get_option_set_fingerprint(option_ids)
+        if fingerprint not in option_sets:
+            cur.execute("INSERT INTO option_sets (option_sets_fingerprint) VALUES (%s);", (fingerprint,))
+            option_sets[fingerprint] = cur.lastrowid
+            cur.executemany("INSERT INTO option_sets_options (option_sets_id, options_id) VALUES (%s, %s);",
+                            [(option_sets[fingerprint], options_id) for options_id in option_ids])
+        cur.execute("UPDATE products SET option_sets_id = %s WHERE products_id = %s;", (option_sets[fingerprint], products_id))
+
+def backfill_product_tags(cur, backend):
+    "Fills product_tags from each product's comma separated tags, normalized like Product.normalize_tags"
+    cur.execute("SELECT products_id, products_tags FROM products;")
+    rows = []
+    for products_id, tags in cur.fetchall():
+        for tag in sorted(set(tag.strip().lower() for tag in (tags or '').split(',') if tag.strip())):
+            rows.append((products_id, tag))
+    cur.executemany("INSERT INTO product_tags (products_id, tag) VALUES (%s, %s);", rows)
+
+# Numbered schema migrations, applied in order. Each migration is a tuple of version, description, and a list
+# of steps. Applied versions are recorded in the schema_version table. Never edit a released migration, add a new one.
+# A step is either an SQL statement understood by every backend, a dict of statements keyed by backend name,
+# or a function accepting a cursor and the backend.
+migrations = [
+    (1, 'Index the columns used by lookups and joins', [
+        # get_product, Product.save and has_collection look products up by handle
+        "CREATE UNIQUE INDEX `products_handle_uq` ON `products` (`products_handle`);",
+        # get_collection and Collection.save look collections up by handle
+        "CREATE UNIQUE INDEX `collections_handle_uq` ON `collections` (`collections_handle`);",
+        # Option duplicate detection selects options by handle, handles aren't unique across attribute sets
+        "CREATE INDEX `options_handle_idx` ON `options` (`options_handle`);",
+        # Option.get_option selects attributes by option
+        "CREATE INDEX `attributes_options_id_idx` ON `attributes` (`options_id`);",
+        # Product.get_options selects by product, the primary key leads with options_id
+        "CREATE INDEX `options_products_products_id_idx` ON `options_products` (`products_id`);",
+        # Collection product gathering selects by collection, the primary key leads with products_id
+        "CREATE INDEX `products_collections_collections_id_idx` ON `products_collections` (`collections_id`);",
+    ]),
+    (2, 'Fingerprint options by handle and attributes for duplicate detection', [
+        "ALTER TABLE `options` ADD COLUMN `options_fingerprint` char(40) NULL;",
+        backfill_options_fingerprint,
+        "CREATE UNIQUE INDEX `options_fingerprint_uq` ON `options` (`options_fingerprint`);",
+    ]),
+    (3, 'Replace per product options_products rows with shared option sets', [
+        # Each distinct set of options is stored once, products with the same options reference the same set
+        {
+            'mysql' : """
+            CREATE TABLE `option_sets`  (
+                `option_sets_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+                `option_sets_fingerprint` char(40) NOT NULL,
+                PRIMARY KEY (`option_sets_id`),
+                UNIQUE KEY `option_sets_fingerprint_uq` (`option_sets_fingerprint`)
+            );
+            """,
+            'sqlite' : """
+            CREATE TABLE `option_sets`  (
+                `option_sets_id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                `option_sets_fingerprint` char(40) NOT NULL UNIQUE
+            );
+            """,
+        },
+        {
+            'mysql' : """
+            CREATE TABLE `option_sets_options`  (
+                `option_sets_id` int(10) unsigned NOT NULL,
+                `options_id` int(10) unsigned NOT NULL,
+                PRIMARY KEY (`option_sets_id`,`options_id`),
+            FOREIGN KEY (option_sets_id) REFERENCES option_sets (option_sets_id)
+              ON UPDATE CASCADE ON DELETE CASCADE,
+            FOREIGN KEY (options_id) REFERENCES options (options_id)
+              ON UPDATE CASCADE ON DELETE CASCADE
+            );
+            """,
+            'sqlite' : """
+            CREATE TABLE `option_sets_options`  (
+                `option_sets_id` INTEGER NOT NULL,
+                `options_id` INTEGER NOT NULL,
+                PRIMARY KEY (`option_sets_id`,`options_id`),
+            FOREIGN KEY (option_sets_id) REFERENCES option_sets (option_sets_id)
+              ON UPDATE CASCADE ON DELETE CASCADE,
+            FOREIGN KEY (options_id) REFERENCES options (options_id)
+              ON UPDATE CASCADE ON DELETE CASCADE
+            );
+            """,
+        },
+        {
+            'mysql' : """
+            ALTER TABLE `products` ADD COLUMN `option_sets_id` int(10) unsigned NULL,
+            ADD FOREIGN KEY (option_sets_id) REFERENCES option_sets (option_sets_id)
+              ON UPDATE CASCADE ON DELETE SET NULL;
+            """,
+            'sqlite' : """
+            ALTER TABLE `products` ADD COLUMN `option_sets_id` INTEGER NULL
+            REFERENCES option_sets (option_sets_id) ON UPDATE CASCADE ON DELETE SET NULL;
+            """,
+        },
+        "CREATE INDEX `products_option_sets_id_idx` ON `products` (`option_sets_id`);",
+        backfill_option_sets,
+        "DROP TABLE `options_products`;",
+    ]),
+    (4, 'Store each product tag in an indexed product_tags table', [
+        # Tags are stored lowercased and trimmed, one row per tag, so tag conditions are an index lookup
+        {
+            'mysql' : """
+            CREATE TABLE `product_tags`  (
+                `products_id` int(10) unsigned NOT NULL,
+                `tag` varchar(255) NOT NULL,
+                PRIMARY KEY (`products_id`,`tag`),
+            FOREIGN KEY (products_id) REFERENCES products (products_id)
+              ON UPDATE CASCADE ON DELETE CASCADE
+            );
+            """,
+            'sqlite' : """
+            CREATE TABLE `product_tags`  (
+                `products_id` INTEGER NOT NULL,
+                `tag` varchar(255) NOT NULL,
+                PRIMARY KEY (`products_id`,`tag`),
+            FOREIGN KEY (products_id) REFERENCES products (products_id)
+              ON UPDATE CASCADE ON DELETE CASCADE
+            );
+            """,
+        },
+        # Tag conditions select products by tag, the primary key leads with products_id
+        "CREATE INDEX `product_tags_tag_idx` ON `product_tags` (`tag`);",
+        backfill_product_tags,
+    ]),
+    (5, 'Track which products and collections changed since collection memberships were evaluated', [
+        # Fingerprints of the values collection conditions match, saved with each product, and of the values
+        # memberships were last evaluated against. Left NULL here, so the next collection import evaluates everything
+        "ALTER TABLE `products` ADD COLUMN `products_conditions_fingerprint` char(40) NULL;",
+        "ALTER TABLE `products` ADD COLUMN `products_evaluated_fingerprint` char(40) NULL;",
+        "ALTER TABLE `collections` ADD COLUMN `collections_conditions_fingerprint` char(40) NULL;",
+    ]),
+]
+
+def get_schema_version(cur):
+    "Returns the highest applied migration version, 0 if none have been applied"
+    cur.execute("SELECT MAX(version) FROM schema_version;")
+    row = cur.fetchone()
+    return row[0] or 0
+
+def run_step(cur, backend, step):
+    if callable(step):
+        step(cur, backend)
+    elif isinstance(step, dict):
+        if backend.name in step:
+            cur.execute(step[backend.name])
+    else:
+        cur.execute(step)
+
+def migrate(con, backend):
+    "Applies every migration newer than the database's schema version, returns the resulting version"
+    cur = con.cursor()
+    cur.execute(schema_version_table[backend.name])
+    version = get_schema_version(cur)
+
+    for migration_version, description, steps in migrations:
+        if migration_version <= version:
+            continue
+        print("Applying migration %d: %s" %(migration_version, description))
+        for step in steps:
+            run_step(cur, backend, step)
+        cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);", (migration_version, description))
+        con.commit()
+        version = migration_version
+
+    print("Database is at schema version %d" %(version))
+    return version
+
+def create_tables(cur, backend):
+    "Drops and creates the base tables, migrations are applied on top of these"
+    # Drop tables
+    for table in drop_order:
+        cur.execute("DROP TABLE IF EXISTS `%s`;" %(table))
+
+    for statement in tables[backend.name]:
+        cur.execute(statement)
+
+def install(con, backend):
+    "Creates a fresh database on con, useful for setting up a ':memory:' SQLite database in the same process"
+    create_tables(con.cursor(), backend)
+    return migrate(con, backend)
+
+def main():
+    try:
+        backend = storage.get_backend()
+        con = backend.connect()
+
+        if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+            migrate(con, backend)
+        else:
+            install(con, backend)
 
-    except mysql.Error as e:
-        print("Error %d: %s" % (e.args[0], e.args[1]))
+    except storage.Error as e:
+        print("Error: %s" % (e))
     finally:
         print("finally")
 
@@ -15,8 +15,13 @@ import io
 import os.path
 import re
 import csv
+import threading
+from collections import OrderedDict
+import time
+import atexit
+import hashlib
 
-import MySQLdb as mysql
+import storage
 
 from bs4 import BeautifulSoup
 from selenium import webdriver
@@ -126,8 +131,83 @@ class BoldOptionScraper:
             options.append(Option(option, attribute))
         return options
 
+class OptionCache:
+    """
+    Bounded, least recently used cache of Option objects keyed by id, which can also be searched by fingerprint.
+    Options and attributes rarely change during a run, so Option.get_option is answered from here when possible.
+    Entries are invalidated when Option.save writes an option
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.fingerprints = {}
+        self.id_fingerprints = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id):
+        "Returns the cached option with the given id, or None"
+        with self.lock:
+            option = self.entries.get(id)
+            if option is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(id)
+            return option
+
+    def get_by_fingerprint(self, fingerprint):
+        "Returns the cached option with the given fingerprint, or None"
+        with self.lock:
+            id = self.fingerprints.get(fingerprint)
+        if id is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        return self.get(id)
+
+    def __remove(self, id):
+        "Removes an entry and its fingerprint, the lock must be held"
+        self.entries.pop(id, None)
+        fingerprint = self.id_fingerprints.pop(id, None)
+        if fingerprint is not None and self.fingerprints.get(fingerprint) == id:
+            del self.fingerprints[fingerprint]
+
+    def put(self, option):
+        if option.id in ('', None):
+            return
+        fingerprint = option.get_fingerprint()
+        with self.lock:
+            self.__remove(option.id)
+            self.entries[option.id] = option
+            self.fingerprints[fingerprint] = option.id
+            self.id_fingerprints[option.id] = fingerprint
+            while len(self.entries) > self.max_entries:
+                self.__remove(next(iter(self.entries)))
+
+    def invalidate(self, id=None, fingerprint=None):
+        "Removes the option with the given id and the option with the given fingerprint"
+        with self.lock:
+            if fingerprint is not None and fingerprint in self.fingerprints:
+                self.__remove(self.fingerprints[fingerprint])
+            if id is not None:
+                self.__remove(id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.fingerprints.clear()
+            self.id_fingerprints.clear()
+
+    def get_stats(self):
+        "Returns a dict of cache hits, misses and current entries"
+        with self.lock:
+            return {'hits' : self.hits, 'misses' : self.misses, 'entries' : len(self.entries), 'max_entries' : self.max_entries}
+
 class Option:
     attributes = []
+    cache = OptionCache(getattr(config, 'option_cache_size', 1000))
 
     def __init__(self, title, attributes, **kwargs):
         self.title = title
@@ -138,20 +218,21 @@ class Option:
     def __repr__(self):
         return self.handle
 
-    def __get_ids_matching_handle(self):
-        with DB() as con:
-            cur = con.cursor()
-            statement = 'select options_id from options where options_handle = "%s"' %(self.handle)
-            cur.execute(statement)
-            ids = [int(row[0]) for row in cur.fetchall()]
-            return ids
+    def get_fingerprint(self):
+        """
+        Returns a hash of the option's handle and sorted attributes. Options with identical handles and attributes
+        share a fingerprint, which is stored in the options table's unique options_fingerprint column
+        """
+        canonical = '\n'.join([self.handle] + sorted(self.attributes))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
 
     def __get_option_insert_statement(self):
-        insert_statement = 'INSERT INTO options (options_handle, options_title) VALUES ("%s", "%s");' %(self.handle, self.title)
-        return insert_statement
+        "Returns an insert that's ignored if an option with the same fingerprint exists"
+        insert_statement = '%s INTO options (options_handle, options_title, options_fingerprint) VALUES (%%s, %%s, %%s);' %(DB.get_backend().insert_ignore)
+        return insert_statement, (self.handle, self.title, self.get_fingerprint())
 
-    def __get_attribute_insert_statement(self, option_id, attribute_title):
-        insert_statement = 'INSERT INTO attributes (options_id, attributes_title) VALUES ("%s", "%s");' %(option_id, attribute_title)
+    def __get_attribute_insert_statement(self):
+        insert_statement = 'INSERT INTO attributes (options_id, attributes_title) VALUES (%s, %s);'
         return insert_statement
 
     def print(self):
@@ -162,116 +243,175 @@ class Option:
 
     def get_option(id):
         "Returns an option object from the database given an id"
+        option = Session.lookup(Option, 'id', id)
+        if option is None:
+            option = Option.cache.get(id)
+        if option is not None:
+            return Session.register(option)
+
         with DB() as con:
             try:
                 cur = con.cursor()
-                option_id_statement = 'select options_title from options where options_id = "%s"' %(id)
-                attributes_id_statement = 'select attributes_title from attributes where options_id = "%s"' %(id)
+                option_id_statement = 'select options_title from options where options_id = %s'
+                attributes_id_statement = 'select attributes_title from attributes where options_id = %s order by attributes_id'
 
-                cur.execute(option_id_statement)
+                cur.execute(option_id_statement, (id,))
                 option_title = cur.fetchall()[0][0]
                 if option_title == '':
                     raise ValueError("Option ID '%s' doesn't exist in DB")
 
-                cur.execute(attributes_id_statement)
+                cur.execute(attributes_id_statement, (id,))
                 attributes = [str(attribute[0]) for attribute in cur.fetchall()]
 
                 option = Option(option_title, attributes, id=id)
-                return option
-            except mysql.Error as e:
+                Option.cache.put(option)
+                return Session.register(option)
+            except storage.Error as e:
                 print("Problem while saving an option to database")
                 #print("Error %d: %s" % (e.args[0], e.args[1]))
                 print(e)
                 print(cur)
                 raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
 
-    def __identical_attribute_exists(self):
-        "Returns true if an option with an identical title and identical attributes already exists in DB"
-        options_with_identical_title = [Option.get_option(id) for id in self.__get_ids_matching_handle()]
-        identical_attributes_exists = False
-        if options_with_identical_title:
-            for option in options_with_identical_title:
-                if sorted(self.attributes) == sorted(option.attributes):
-                    identical_attributes_exists = True
-                    return True
-                    break
-        return False
-
     def __get_id(self):
-        "Returns true if an option with an identical title and identical attributes already exists in DB"
-        options = []
-        for id in self.__get_ids_matching_handle():
-            option = Option.get_option(id)
-            option_id = id
-            options.append((option, option_id))
+        "Returns the id of the option with an identical title and identical attributes in DB, or None"
+        option = Option.cache.get_by_fingerprint(self.get_fingerprint())
+        if option is not None:
+            return option.id
 
-        for option in options:
-            if sorted(self.attributes) == sorted(option[0].attributes):
-                return option[1]
+        with DB() as con:
+            cur = con.cursor()
+            cur.execute('select options_id from options where options_fingerprint = %s', (self.get_fingerprint(),))
+            row = cur.fetchone()
+            if row:
+                return row[0]
 
     def associate_with_product(self, product_handle):
+        "Associates the option with a product given its handle. Does nothing if they're already associated"
+        # check if id is set on the object, otherwise use __get_id to retrieve it from the database
+        if hasattr(self, "id") and self.id != '':
+            option_id = self.id
+        else:
+            option_id = self.__get_id()
+
         with DB() as con:
-            try:
-                # check if id is set on the object, otherwise use __get_id to retrieve it from the database
-                if hasattr(self, "id") and self.id != '':
-                    option_id = self.id
-                else:
-                    option_id = self.__get_id()
-
-                # Get product
-                product = Product.get_product(product_handle)
-                products_id = product.id
-
-                # Check if option is already associated with the product
-                product_already_has_option = False
-                product_options = product.get_options()
-                for product_option in product_options:
-                    if product_option.id == option_id:
-                        product_already_has_option = True
-                        break
-
-                if option_id and products_id and not product_already_has_option:
-                    cur = con.cursor()
-                    o_p_statement = 'insert into options_products (options_id, products_id) values (%d, %d)' %(option_id, products_id)
-                    cur.execute(o_p_statement)
-                    con.commit()
-                    logging.debug('Associating option "%s: %s" to product "%s"' %(option_id, self.handle, product_handle))
-                elif product_already_has_option:
-                    logging.debug('Option "%s: %s" already associated to product "%s", skipping' %(option_id, self.handle, product_handle))
-                else:
-                    raise ValueError("An error occured while associating option with product")
-            except mysql.Error as e:
-                print("Problem while saving an option to database")
-                #print("Error %d: %s" % (e.args[0], e.args[1]))
-                print(e)
-                print(cur)
-                raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+            cur = con.cursor()
+            cur.execute('select products_id from products where products_handle = %s', (product_handle,))
+            row = cur.fetchone()
+            if not option_id or not row:
+                raise ValueError("An error occured while associating option with product")
+            Option.associate_with_products([(option_id, row[0])], cur)
+            con.commit()
+            logging.debug('Associating option "%s: %s" to product "%s"' %(option_id, self.handle, product_handle))
+
+    def associate_with_products(pairs, cur):
+        """
+        Associates many options with many products at once, given a list of (options_id, products_id) pairs.
+        Each product is pointed at the option set holding its current options plus the new ones, sets are created
+        as needed. Products that already have their options are left alone
+        """
+        s = None
+        try:
+            pairs = list(pairs)
+            product_ids = list(dict.fromkeys(products_id for options_id, products_id in pairs))
+
+            current = dict((products_id, set()) for products_id in product_ids)
+            for i in range(0, len(product_ids), 1000):
+                chunk = product_ids[i:i + 1000]
+                s = """
+                SELECT p.products_id, sso.options_id FROM products AS p
+                JOIN option_sets_options AS sso ON sso.option_sets_id = p.option_sets_id
+                WHERE p.products_id IN (%s)
+                """ % (', '.join(['%s'] * len(chunk)))
+                cur.execute(s, chunk)
+                for products_id, options_id in cur.fetchall():
+                    current[products_id].add(options_id)
+
+            wanted = dict((products_id, set(option_ids)) for products_id, option_ids in current.items())
+            for options_id, products_id in pairs:
+                wanted[products_id].add(options_id)
+
+            option_set_ids = {}
+            updates = []
+            for products_id in product_ids:
+                if wanted[products_id] == current[products_id]:
+                    logging.debug('Options %s already associated to product "%s", skipping' %(sorted(wanted[products_id]), products_id))
+                    continue
+                option_ids = frozenset(wanted[products_id])
+                if option_ids not in option_set_ids:
+                    option_set_ids[option_ids] = OptionSet.get_or_create(option_ids, cur)
+                updates.append((option_set_ids[option_ids], products_id))
+
+            s = 'UPDATE products SET option_sets_id = %s WHERE products_id = %s'
+            cur.executemany(s, updates)
+            logging.debug('Associated %d products with option sets' %(len(updates)))
+        except storage.Error as e:
+            print("Problem while saving an option to database")
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+
+        # Options loaded into memory for these products are stale now
+        for set_id, products_id in updates:
+            product = Session.lookup(Product, 'id', products_id)
+            if product is not None:
+                product.options = None
 
     def save(self, cur):
+        "Inserts the option and its attributes, unless an option with identical attributes exists. Sets id either way"
+        s = None
         try:
-            if not self.__identical_attribute_exists():
-                # Insert option into db
-                option_s = self.__get_option_insert_statement()
-                cur.execute(option_s)
-                option_id = cur.lastrowid
+            # Insert option into db, ignored if its fingerprint exists
+            s, option_values = self.__get_option_insert_statement()
+            cur.execute(s, option_values)
+            if cur.rowcount == 1:
                 # Set id on object, in case associate_with_product is invoked later
-                self.id = option_id
+                self.id = cur.lastrowid
+                Option.cache.invalidate(id=self.id, fingerprint=option_values[2])
                 logging.debug('inserting option "%s" in DB' %(self.handle))
 
                 # Insert attributes into db, and associate them with the option
-                for attribute in self.attributes:
-                    logging.debug('associating attribute "%s" to option "%s"  in DB' %(attribute, self.handle))
-                    option_a = self.__get_attribute_insert_statement(option_id, attribute)
-                    cur.execute(option_a)
+                logging.debug('associating attributes %s to option "%s" in DB' %(self.attributes, self.handle))
+                s = self.__get_attribute_insert_statement()
+                cur.executemany(s, [(self.id, attribute) for attribute in self.attributes])
             else:
+                s = 'select options_id from options where options_fingerprint = %s'
+                cur.execute(s, (option_values[2],))
+                self.id = cur.fetchone()[0]
                 logging.debug('Option with title "%s", and identical attributes exists in db, skipping insert' %(self.handle))
-        except mysql.Error as e:
+        except storage.Error as e:
             print("Problem while saving an option to database")
             #print("Error %d: %s" % (e.args[0], e.args[1]))
             print(e)
             print(cur)
             raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
 
+class OptionSet:
+    """
+    A distinct set of options. Each set is stored once in option_sets and option_sets_options, and every product
+    carrying exactly those options references it through products.option_sets_id, so options are resolved once
+    per set instead of once per product. Sets don't change once created; a product gaining an option is pointed
+    at the set with that option added
+    """
+    def get_fingerprint(option_ids):
+        "Returns a hash identifying a set of option ids, stored in the unique option_sets_fingerprint column"
+        canonical = ','.join(str(option_id) for option_id in sorted(set(option_ids)))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def get_or_create(option_ids, cur):
+        "Returns the id of the option set containing exactly option_ids, creating it if it doesn't exist"
+        fingerprint = OptionSet.get_fingerprint(option_ids)
+        s = '%s INTO option_sets (option_sets_fingerprint) VALUES (%%s)' %(DB.get_backend().insert_ignore)
+        cur.execute(s, (fingerprint,))
+        if cur.rowcount == 1:
+            option_sets_id = cur.lastrowid
+            s = 'INSERT INTO option_sets_options (option_sets_id, options_id) VALUES (%s, %s)'
+            cur.executemany(s, [(option_sets_id, options_id) for options_id in sorted(set(option_ids))])
+            logging.debug('Created option set %s with options %s' %(option_sets_id, sorted(set(option_ids))))
+            return option_sets_id
+
+        cur.execute('select option_sets_id from option_sets where option_sets_fingerprint = %s', (fingerprint,))
+        return cur.fetchone()[0]
+
 class ShopifyCSV:
     mappings = {
         "Handle" : "handle",
@@ -433,7 +573,7 @@ class ShopifyCSV:
         elif attribute == "NONE":
             return self.__tmp_handle_none_defaults(mapping, product)
         else:
-            return product.__getattribute__(attribute)
+            return getattr(product, attribute)
 
     def __build_csv(self):
         # Build csv_header
@@ -653,6 +793,9 @@ class GoogleFeed:
         logging.info('- Building Google Feed')
         print('Building Google Feed...')
 
+        # Fetch every product's options up front instead of once per product and variant
+        Product.load_options([product for collection in self.collections for product in collection.products])
+
         # Add products to the feed
         for collection in self.collections:
             for product in collection.products:
@@ -796,7 +939,7 @@ class GoogleFeed:
         elif attribute == "NONE":
             result_attribute = self.__tmp_handle_none_defaults(mapping, product)
         else:
-            result_attribute = product.__getattribute__(attribute)
+            result_attribute = getattr(product, attribute)
 
         # Quote wrap the result_attribute
         result_attribute = '"%s"' %(result_attribute)
@@ -848,22 +991,589 @@ class GoogleFeed:
             # Finally, add the product to the list.
             self.products.append(product)
 
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of database connections.
+    Idle connections are health checked when borrowed, and replaced if the check fails.
+    Borrowers wait up to timeout seconds for a connection when the pool is at max_size.
+    """
+    def __init__(self, connect, ping, max_size=5, timeout=30):
+        self.connect = connect
+        self.ping = ping
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
+        self.counters = {
+            'created' : 0,
+            'reused' : 0,
+            'borrowed' : 0,
+            'returned' : 0,
+            'discarded' : 0,
+            'health_check_failures' : 0,
+            'waits' : 0,
+        }
+
+    def __count(self, counter):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def __is_healthy(self, con):
+        try:
+            self.ping(con)
+            return True
+        except Exception as e:
+            logging.warning("Pooled database connection failed health check: %s" %(e))
+            return False
+
+    def __close(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        "Borrows a connection from the pool, opening a new one if no idle connection is available"
+        con = None
+        with self.condition:
+            while not self.idle and self.size >= self.max_size:
+                self.counters['waits'] += 1
+                if not self.condition.wait(self.timeout):
+                    raise ValueError("Timed out waiting for a database connection, pool size is %d" %(self.max_size))
+            self.counters['borrowed'] += 1
+            if self.idle:
+                con = self.idle.pop()
+            else:
+                self.size += 1
+
+        if con is not None:
+            if self.__is_healthy(con):
+                self.__count('reused')
+                return con
+            self.__count('health_check_failures')
+            self.__close(con)
+
+        try:
+            con = self.connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        self.__count('created')
+        return con
+
+    def release(self, con, discard=False):
+        "Returns a borrowed connection to the pool. Uncommitted work is rolled back, as it would be on close"
+        if not discard:
+            try:
+                con.rollback()
+            except Exception as e:
+                logging.warning("Discarding pooled database connection, rollback failed: %s" %(e))
+                discard = True
+
+        with self.condition:
+            if discard:
+                self.counters['discarded'] += 1
+                self.size -= 1
+            else:
+                self.counters['returned'] += 1
+                self.idle.append(con)
+            self.condition.notify()
+
+        if discard:
+            self.__close(con)
+
+    def close_all(self):
+        "Closes every idle connection. Borrowed connections are closed when they're released with discard=True"
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+        for con in idle:
+            self.__close(con)
+
+    def get_stats(self):
+        "Returns a dict of pool counters along with the current size, idle and in use connection counts"
+        with self.condition:
+            stats = dict(self.counters)
+            stats['size'] = self.size
+            stats['max_size'] = self.max_size
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = self.size - len(self.idle)
+        return stats
+
+class QueryTracer:
+    """
+    Records every statement run through the cursors of traced DB connections. Statements are grouped by call site
+    and statement shape (the statement with its literals and parameters replaced by ?), keeping the count,
+    latencies and rows returned of each group.
+
+    When warn_threshold is set, a warning is logged the first time a statement shape runs more than warn_threshold
+    times from the same calling line, which usually means a query is being run once per row inside a loop (N+1).
+
+    Tracing is enabled with db_trace in config.py, or by calling QueryTracer.enable()
+    """
+    active = None
+
+    shape_regexes = [
+        (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+        (re.compile(r'"(?:[^"\\]|\\.|"")*"'), '?'),
+        (re.compile(r'%s'), '?'),
+        (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+        (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(...)'),
+        (re.compile(r'(\(\.\.\.\)|\(\?\))(?:\s*,\s*(?:\(\.\.\.\)|\(\?\)))+'), r'\1'),
+        (re.compile(r'\s+'), ' '),
+    ]
+
+    def __init__(self, warn_threshold=None):
+        self.warn_threshold = warn_threshold
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(warn_threshold=None, report_at_exit=True):
+        "Starts tracing DB connections and returns the tracer. The summary is printed at exit unless report_at_exit is False"
+        tracer = QueryTracer(warn_threshold)
+        QueryTracer.active = tracer
+        if report_at_exit:
+            atexit.register(tracer.report)
+        return tracer
+
+    def disable():
+        "Stops tracing connections borrowed from now on"
+        QueryTracer.active = None
+
+    def reset(self):
+        with self.lock:
+            self.groups = {}
+            self.loop_counts = {}
+            self.warned = set()
+
+    def get_shape(statement):
+        "Returns the statement with literals and parameters replaced by ?, and lists of them collapsed"
+        for regex, replacement in QueryTracer.shape_regexes:
+            statement = regex.sub(replacement, statement)
+        return statement.strip()
+
+    def __get_site(frame):
+        code = frame.f_code
+        return '%s:%d %s' %(os.path.basename(code.co_filename), frame.f_lineno, getattr(code, 'co_qualname', code.co_name))
+
+    def record(self, statement, elapsed, frame):
+        "Records a statement run from frame, taking elapsed seconds. Returns the group key rows should be counted against"
+        shape = QueryTracer.get_shape(statement)
+        site = QueryTracer.__get_site(frame)
+        caller = QueryTracer.__get_site(frame.f_back) if frame.f_back else ''
+        key = (site, shape)
+
+        warn = False
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {'site' : site, 'shape' : shape, 'count' : 0, 'total' : 0.0, 'latencies' : [], 'rows' : 0}
+            group['count'] += 1
+            group['total'] += elapsed
+            group['latencies'].append(elapsed)
+
+            if self.warn_threshold:
+                loop_key = (caller, shape)
+                self.loop_counts[loop_key] = self.loop_counts.get(loop_key, 0) + 1
+                if self.loop_counts[loop_key] > self.warn_threshold and loop_key not in self.warned:
+                    self.warned.add(loop_key)
+                    warn = True
+
+        if warn:
+            logging.warning('Possible N+1 query: statement ran more than %d times from %s (via %s): %s' %(self.warn_threshold, caller, site, shape))
+        return key
+
+    def record_rows(self, key, rows):
+        with self.lock:
+            self.groups[key]['rows'] += rows
+
+    def __percentile(latencies, percentile):
+        index = int(round(percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def get_summary(self):
+        "Returns a list of dicts describing each statement group, most total time first. Times are in milliseconds"
+        summary = []
+        with self.lock:
+            groups = [dict(group, latencies=sorted(group['latencies'])) for group in self.groups.values()]
+        for group in groups:
+            latencies = group.pop('latencies')
+            group['total'] = group['total'] * 1000
+            for percentile in [50, 95, 99]:
+                group['p%d' %(percentile)] = QueryTracer.__percentile(latencies, percentile) * 1000
+            summary.append(group)
+        summary.sort(key=lambda group: group['total'], reverse=True)
+        return summary
+
+    def report(self, file=None):
+        "Prints the summary (to stdout unless a file is given) and writes it to the log"
+        summary = self.get_summary()
+        lines = ['Query summary: %d statements in %d groups' %(sum(group['count'] for group in summary), len(summary))]
+        lines.append('%8s %10s %8s %8s %8s %8s  %s' %('count', 'total ms', 'p50 ms', 'p95 ms', 'p99 ms', 'rows', 'site / statement'))
+        for group in summary:
+            lines.append('%8d %10.1f %8.2f %8.2f %8.2f %8d  %s' %(group['count'], group['total'], group['p50'], group['p95'], group['p99'], group['rows'], group['site']))
+            lines.append('%s  %s' %(' ' * 57, group['shape']))
+        report_str = '\n'.join(lines)
+        print(report_str, file=file)
+        logging.info(report_str)
+
+class TracedCursor:
+    "Wraps a cursor, recording each statement and the rows fetched from it with a QueryTracer"
+    def __init__(self, cur, tracer):
+        self.cur = cur
+        self.tracer = tracer
+        self.key = None
+
+    def __run(self, method, statement, args, frame):
+        start = time.perf_counter()
+        try:
+            return method(statement, args)
+        finally:
+            self.key = self.tracer.record(statement, time.perf_counter() - start, frame)
+
+    def execute(self, statement, args=None):
+        return self.__run(self.cur.execute, statement, args, sys._getframe(1))
+
+    def executemany(self, statement, args):
+        return self.__run(self.cur.executemany, statement, args, sys._getframe(1))
+
+    def __count(self, rows):
+        if self.key is not None:
+            self.tracer.record_rows(self.key, rows)
+
+    def fetchone(self):
+        row = self.cur.fetchone()
+        if row is not None:
+            self.__count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cur.fetchmany(*args)
+        self.__count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cur.fetchall()
+        self.__count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self.cur:
+            self.__count(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+class TracedConnection:
+    "Wraps a connection so the cursors it hands out are traced"
+    def __init__(self, con, tracer):
+        self.con = con
+        self.tracer = tracer
+
+    def cursor(self, *args):
+        return TracedCursor(self.con.cursor(*args), self.tracer)
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
 class DB:
     """
-    Sets up a db
+    Sets up a db. Connections are borrowed from a shared ConnectionPool and returned to it on exit,
+    instead of being opened and closed for every use.
     """
-    def __init__(self, **kwargs):
+    pool = None
+    pool_lock = threading.Lock()
+    backend = None
+    local = threading.local()
+
+    def get_backend():
+        "Returns the storage backend selected by db_backend in config.py"
+        if DB.backend is None:
+            DB.backend = storage.get_backend()
+        return DB.backend
+
+    def connect():
         try:
-            self.con = mysql.connect(config.db_host, config.db_user, config.db_password, config.db_name)
-        except mysql.Error as e:
+            return DB.get_backend().connect()
+        except storage.Error as e:
             print("Problem connecting to database")
-            print("Error %d: %s" % (e.args[0], e.args[1]))
+            print(e)
+            raise
+
+    def ping(con):
+        DB.get_backend().ping(con)
+
+    def dict_cursor(con):
+        "Returns a cursor on con that fetches rows as dicts keyed by column name"
+        if isinstance(con, TracedConnection):
+            return TracedCursor(DB.get_backend().dict_cursor(con.con), con.tracer)
+        return DB.get_backend().dict_cursor(con)
+
+    def insert_rows(cur, table, columns, rows, chunk_size=1000, ignore=False):
+        "Inserts rows (sequences of values in columns order) with one multi-row INSERT per chunk_size rows"
+        insert = DB.get_backend().insert_ignore if ignore else 'INSERT'
+        row_placeholders = '(%s)' % (', '.join(['%s'] * len(columns)))
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            statement = '%s INTO %s (%s) VALUES %s' % (insert, table, ', '.join(columns), ', '.join([row_placeholders] * len(chunk)))
+            cur.execute(statement, [value for row in chunk for value in row])
+
+    def streaming_cursor(con):
+        "Returns an unbuffered cursor on con that fetches rows as dicts, see the backend's streaming_dict_cursor"
+        if isinstance(con, TracedConnection):
+            return TracedCursor(DB.get_backend().streaming_dict_cursor(con.con), con.tracer)
+        return DB.get_backend().streaming_dict_cursor(con)
+
+    def get_pool():
+        "Returns the shared connection pool, creating it on first use"
+        if DB.pool is None:
+            with DB.pool_lock:
+                if DB.pool is None:
+                    if getattr(config, 'db_trace', False) and QueryTracer.active is None:
+                        QueryTracer.enable(getattr(config, 'db_trace_warn_threshold', None))
+                    DB.pool = ConnectionPool(DB.connect, DB.ping,
+                                             max_size=getattr(config, 'db_pool_size', 5),
+                                             timeout=getattr(config, 'db_pool_timeout', 30))
+        return DB.pool
+
+    def get_pool_stats():
+        "Returns connection pool statistics, see ConnectionPool.get_stats"
+        return DB.get_pool().get_stats()
+
+    def close_pool():
+        "Closes all idle pooled connections"
+        if DB.pool is not None:
+            DB.pool.close_all()
+
+    def open_blocks():
+        "Returns the DB blocks currently open in this thread, innermost last"
+        if not hasattr(DB.local, 'blocks'):
+            DB.local.blocks = []
+        return DB.local.blocks
+
+    def __init__(self, **kwargs):
+        self.pool = DB.get_pool()
+        self.con = self.pool.acquire()
 
     def __enter__(self):
+        DB.open_blocks().append(self)
+        if QueryTracer.active is not None:
+            return TracedConnection(self.con, QueryTracer.active)
         return self.con
 
     def __exit__(self, type, value, traceback):
-        self.con.close()
+        # Connections that raised a database error may be in a bad state, don't hand them out again
+        discard = type is not None and issubclass(type, storage.Error)
+        DB.open_blocks().remove(self)
+        self.pool.release(self.con, discard=discard)
+
+class Session:
+    """
+    Identity map for the products, collections and options loaded during a driver run.
+    While a session is active, loaders return the object already held by the session for a given id or handle,
+    so repeated lookups are served from memory, and changes made through one reference are seen through all of them.
+
+        with Session():
+            collections = Collection.get_collections()
+            ...
+    """
+    local = threading.local()
+
+    # Keys each type is mapped by. Option handles aren't unique, so options are only mapped by id
+    keys = {
+        'Product' : ('id', 'handle'),
+        'Collection' : ('id', 'handle'),
+        'Option' : ('id',),
+    }
+
+    def __init__(self):
+        self.identity_map = {}
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = Session.current()
+        Session.local.session = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        Session.local.session = self.previous
+        self.previous = None
+
+    def current():
+        "Returns the session active in this thread, or None"
+        return getattr(Session.local, 'session', None)
+
+    def lookup(cls, key, value):
+        "Returns the object of type cls with the given key value from the active session, or None"
+        session = Session.current()
+        if session is None:
+            return None
+        return session.get(cls, key, value)
+
+    def register(obj):
+        "Adds obj to the active session. Returns the object the session holds for obj's keys, which is obj unless it was already loaded"
+        session = Session.current()
+        if session is None:
+            return obj
+        return session.add(obj)
+
+    def loaded(cls):
+        "Returns the distinct objects of type cls held by the active session"
+        session = Session.current()
+        if session is None:
+            return []
+        objects = {}
+        for (kind, key, value), obj in session.identity_map.items():
+            if kind == cls.__name__:
+                objects[id(obj)] = obj
+        return list(objects.values())
+
+    def get(self, cls, key, value):
+        return self.identity_map.get((cls.__name__, key, value))
+
+    def add(self, obj):
+        kind = type(obj).__name__
+        key_values = [(key, getattr(obj, key, '')) for key in Session.keys[kind]]
+        key_values = [(key, value) for key, value in key_values if value not in ('', None)]
+
+        for key, value in key_values:
+            existing = self.identity_map.get((kind, key, value))
+            if existing is not None:
+                return existing
+
+        for key, value in key_values:
+            self.identity_map[(kind, key, value)] = obj
+        return obj
+
+    def clear(self):
+        self.identity_map = {}
+
+class WriteBuffer:
+    """
+    Write-behind buffer for product saves. While a buffer is active, saving a product loaded from the database
+    queues its changed fields instead of writing them. Later saves of the same product are merged into the queued
+    changes, and everything is written in bulk when the buffer exits, or once max_size products are queued.
+    Queued changes are written on the cursor passed to the last save while that save's DB block is still open,
+    so they're committed with the caller's transaction and never wait on its locks from another connection.
+    Otherwise they're written on a pooled connection that's committed. New products are still saved immediately,
+    so they get their ids.
+
+        with Session(), WriteBuffer():
+            collections = Collection.get_collections()
+            ...
+
+    Queued changes aren't visible to queries until they're flushed. Combine the buffer with a Session so loaders
+    return the changed objects, and call flush() before reading changed fields back from the database.
+    Changes still queued when the block exits with an exception are discarded
+    """
+    local = threading.local()
+
+    def __init__(self, max_size=None):
+        "max_size defaults to config.db_write_batch_size"
+        if max_size is None:
+            max_size = getattr(config, 'db_write_batch_size', 1000)
+        self.max_size = max_size
+        # Maps each queued product's id to a dict of the column values to write
+        self.pending = OrderedDict()
+        # Queued products whose tags changed, by id
+        self.tag_products = {}
+        # The cursor passed to the last save and the DB block that was open around it
+        self.cur = None
+        self.owner = None
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = WriteBuffer.current()
+        WriteBuffer.local.buffer = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        WriteBuffer.local.buffer = self.previous
+        self.previous = None
+        if type is None:
+            self.flush()
+        elif self.pending:
+            logging.warn('Discarding %d buffered product saves after an exception' %(len(self.pending)))
+            self.pending.clear()
+            self.tag_products.clear()
+        self.cur = self.owner = None
+
+    def current():
+        "Returns the write buffer active in this thread, or None"
+        return getattr(WriteBuffer.local, 'buffer', None)
+
+    def flush_current(cur=None):
+        "Flushes the write buffer active in this thread, if any, see flush"
+        buffer = WriteBuffer.current()
+        if buffer is not None:
+            buffer.flush(cur)
+
+    def owner_cursor():
+        """
+        Returns the cursor of the transaction the active buffer's changes are queued for, while its DB block
+        is still open, or None. Writes that would otherwise take their own connection run on it
+        """
+        buffer = WriteBuffer.current()
+        if buffer is None or buffer.owner not in DB.open_blocks():
+            return None
+        return buffer.cur
+
+    def add(self, product, columns, cur):
+        """
+        Queues a dict of column values to write for product, merged into the values already queued for it.
+        cur is taken to belong to the innermost DB block open in this thread. Once max_size products are queued
+        they're flushed on cur, the saving caller's cursor, to be committed by its owner
+        """
+        blocks = DB.open_blocks()
+        self.cur = cur
+        self.owner = blocks[-1] if blocks else None
+        self.pending.setdefault(product.id, {}).update(columns)
+        if 'products_tags' in columns:
+            self.tag_products[product.id] = product
+        if len(self.pending) >= self.max_size:
+            self.flush(cur)
+
+    def flush(self, cur=None):
+        """
+        Writes every queued change, with one executemany per distinct set of changed columns.
+        Changes are written on cur if given, or on the last save's cursor while its DB block is open,
+        to be committed by their owner, otherwise on a connection that's committed
+        """
+        if not self.pending:
+            return
+        if cur is None and self.owner in DB.open_blocks():
+            cur = self.cur
+        if cur is None:
+            with DB() as con:
+                self.flush(con.cursor())
+                con.commit()
+            return
+
+        groups = OrderedDict()
+        for products_id, columns in self.pending.items():
+            names = tuple(sorted(columns))
+            groups.setdefault(names, []).append([columns[name] for name in names] + [products_id])
+
+        s = None
+        try:
+            for names, rows in groups.items():
+                s = 'UPDATE products SET %s WHERE products_id = %%s' % (', '.join(['%s = %%s' % (name) for name in names]))
+                cur.executemany(s, rows)
+        except storage.Error as e:
+            print("Problem while flushing buffered product saves to database")
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+        Product.save_tags(list(self.tag_products.values()), cur)
+        logging.debug('Flushed %d buffered product saves in %d statements' %(len(self.pending), len(groups)))
+
+        self.pending.clear()
+        self.tag_products.clear()
 
 class Product:
     """
@@ -871,7 +1581,6 @@ class Product:
     marked with g_
     """
     fields = { "id":"products_id", "handle":"products_handle", "title":"products_title", "price":"products_price", "desc":"products_desc", "vendor":"products_vendor", "sku":"products_sku", "tags":"products_tags", "url":"products_url", "img_url":"products_img_url", "g_age_group":"products_g_age_group", "g_color":"products_g_color", "g_product_category":"products_g_product_category", "g_gender":"products_g_gender" }
-    sql_field_type = { "products_id":"%s", "products_handle":"%s", "products_title":"%s", "products_price":"%f", "products_desc":"%s", "products_vendor":"%s", "products_sku":"%s", "products_tags":"%s", "products_url":"%s", "products_img_url":"%s", "products_g_age_group":"%s", "products_g_color":"%s", "products_g_product_category":"%s","products_g_gender":"%s"}
     def __init__(self, title, **kwargs):
         self.title = title
         self.handle = kwargs.get('handle',Product.get_handle(title))
@@ -881,6 +1590,8 @@ class Product:
         self.sku = kwargs.get('sku', '')
 
         self.tags = kwargs.get('tags','')
+        # Normalized tags and the tags string they were computed from, see get_tag_set
+        self.__tag_set = (None, frozenset())
 
         self.url= kwargs.get('url','')
         self.img_url = kwargs.get('img_url','')
@@ -892,38 +1603,83 @@ class Product:
         self.g_color = kwargs.get('g_color','')
         self.g_product_category = kwargs.get('g_product_category','')
         self.g_gender = kwargs.get('g_gender','')
+
+        # Options attached by Product.load_options, None until loaded
+        self.options = None
+
+        # Field values as last loaded from or saved to the database, None until then. See get_changed_fields
+        self.__saved_values = None
         #logging.debug('Product object instantiated, handle: %s' % (self.handle))
 
     def print_product(self):
         p_str = "Product Handle: %s" %(self.handle)
         for field in self.fields:
-            p_str += "%s: %s\n" %(field,self.__getattribute__(field))
+            p_str += "%s: %s\n" %(field,getattr(self, field))
         return p_str
 
-    def get_all_products():
+    def get_select_columns(fields=None):
+        """
+        Returns the column list selecting the given fields, with id and handle always included, or '*' for every column.
+        Loaders accept fields to skip columns like products_desc, fields left out are loaded when they're first read
+        """
+        if fields is None:
+            return '*'
+        for field in fields:
+            if field not in Product.fields:
+                raise ValueError("Unknown product field '%s'" %(field))
+        fields = ['id', 'handle'] + [field for field in fields if field not in ('id', 'handle')]
+        return ', '.join(Product.fields[field] for field in dict.fromkeys(fields))
+
+    def get_all_products(fields=None):
+        "Returns every product, loading only the given fields if fields is a list of field names"
         with DB() as con:
-            product_handles = []
-            cur = con.cursor()
-            statement = "select products_handle from products"
+            cur = DB.dict_cursor(con)
+            statement = "select %s from products" %(Product.get_select_columns(fields))
             cur.execute(statement)
-            for row in cur.fetchall():
-                handle = row[0]
-                product_handles.append(handle)
-            return [Product.get_product(handle) for handle in product_handles]
+            return [Product.from_row(row) for row in cur.fetchall()]
 
-    def get_orphans():
+    def iter_all(batch_size=1000, fields=None):
+        """
+        Yields every product, fetching batch_size rows at a time from an unbuffered server side cursor
+        so the whole catalog is never held in memory. A connection is held until iteration finishes.
+        Streamed products aren't added to the active session, which would otherwise hold every one of them
+        """
+        with DB() as con:
+            cur = DB.streaming_cursor(con)
+            cur.execute("select %s from products" %(Product.get_select_columns(fields)))
+            rows = cur.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield Product.from_row(row, register=False)
+                rows = cur.fetchmany(batch_size)
+            cur.close()
+
+    def get_orphans(batch_size=1000):
+        """
+        Returns the products that aren't in any collection, found with one streamed anti-join.
+        Only id and handle are loaded, other fields are loaded when they're first read
+        """
         orphans = []
-        all_products = Product.get_all_products()
-        for product in all_products:
-            if not product.has_collection():
-                orphans.append(product)
+        with DB() as con:
+            cur = DB.streaming_cursor(con)
+            cur.execute("""
+            SELECT p.products_id, p.products_handle FROM products AS p
+            LEFT JOIN products_collections AS pc ON pc.products_id = p.products_id
+            WHERE pc.products_id IS NULL
+            """)
+            rows = cur.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    orphans.append(Product.from_row(row, register=False))
+                rows = cur.fetchmany(batch_size)
+            cur.close()
         return orphans
 
     def has_collection(self):
         with DB() as con:
             cur = con.cursor()
-            statement = "select products_handle from products join products_collections on products.products_id=products_collections.products_id where products_handle = '%s'" %(self.handle)
-            cur.execute(statement)
+            statement = "select products_handle from products join products_collections on products.products_id=products_collections.products_id where products_handle = %s"
+            cur.execute(statement, (self.handle,))
             has = cur.fetchall()
             if has:
                 return True
@@ -931,17 +1687,79 @@ class Product:
                 return False
 
     def get_options(self):
-        "Returns options associated with the product"
+        "Returns options associated with the product, from memory if they were attached by Product.load_options"
+        if self.options is not None:
+            return self.options
+
         with DB() as con:
             if not hasattr(self, 'id'):
                 raise ValueError("Product object doesn't have an associated ID")
             cur = con.cursor()
-            statement = "select options_id from options_products where products_id = %d" %(self.id)
-            cur.execute(statement)
+            statement = "select sso.options_id from products AS p JOIN option_sets_options AS sso ON sso.option_sets_id = p.option_sets_id where p.products_id = %s"
+            cur.execute(statement, (self.id,))
             option_ids = [row[0] for row in cur.fetchall()]
             options = [Option.get_option(option_id) for option_id in option_ids]
             return options
 
+    def load_options(products, chunk_size=1000):
+        """
+        Fetches the options and attributes of a list of products and attaches them to the products,
+        so get_options is answered from memory. Options are resolved once per option set, with one query
+        mapping products to sets and one join fetching the sets' options per chunk_size keys.
+        Products sharing an option share the same Option object
+        """
+        products = [product for product in products if product.id not in ('', None)]
+        product_ids = list(dict.fromkeys(product.id for product in products))
+        product_sets = {}
+        set_options = {}
+        options = {}
+        attributes_read_from = {}
+
+        with DB() as con:
+            cur = con.cursor()
+            for i in range(0, len(product_ids), chunk_size):
+                chunk = product_ids[i:i + chunk_size]
+                statement = "SELECT products_id, option_sets_id FROM products WHERE option_sets_id IS NOT NULL AND products_id IN (%s)" % (', '.join(['%s'] * len(chunk)))
+                cur.execute(statement, chunk)
+                for products_id, option_sets_id in cur.fetchall():
+                    product_sets[products_id] = option_sets_id
+
+            set_ids = list(dict.fromkeys(product_sets.values()))
+            for i in range(0, len(set_ids), chunk_size):
+                chunk = set_ids[i:i + chunk_size]
+                statement = """
+                SELECT sso.option_sets_id, o.options_id, o.options_title, a.attributes_title
+                FROM option_sets_options AS sso
+                JOIN options AS o ON o.options_id = sso.options_id
+                LEFT JOIN attributes AS a ON a.options_id = o.options_id
+                WHERE sso.option_sets_id IN (%s)
+                ORDER BY sso.option_sets_id, o.options_id, a.attributes_id
+                """ % (', '.join(['%s'] * len(chunk)))
+                cur.execute(statement, chunk)
+
+                for option_sets_id, options_id, options_title, attributes_title in cur.fetchall():
+                    if options_id not in options:
+                        option = Session.lookup(Option, 'id', options_id)
+                        if option is None:
+                            option = Option(options_title, [], id=options_id)
+                            # Every set's rows repeat the option's attributes, read them from the first set only
+                            attributes_read_from[options_id] = option_sets_id
+                        options[options_id] = option
+                    option = options[options_id]
+
+                    if attributes_title is not None and attributes_read_from.get(options_id) == option_sets_id:
+                        option.attributes.append(str(attributes_title))
+
+                    options_in_set = set_options.setdefault(option_sets_id, [])
+                    if not options_in_set or options_in_set[-1] is not option:
+                        options_in_set.append(option)
+
+        for option in options.values():
+            Option.cache.put(option)
+            Session.register(option)
+        for product in products:
+            product.options = list(set_options.get(product_sets.get(product.id), []))
+
     def scrape_bold_product_options(self):
         "Scrapes bold product options from product page and inserts them into the DB"
         logging.debug("Scraping product options for %s" %(self.handle))
@@ -961,12 +1779,15 @@ class Product:
             attempts += 1
 
         if options:
+            if self.id in ('', None):
+                self.id = Product.get_product(self.handle).id
             with DB() as con:
                 cur = con.cursor()
                 for option in options:
                     option.save(cur)
-                    con.commit()
-                    option.associate_with_product(self.handle)
+                Option.associate_with_products([(option.id, self.id) for option in options], cur)
+                con.commit()
+            self.options = None
         else:
             logging.info("No options found for product %s" %(self.handle))
             if scraper.options_available():
@@ -975,21 +1796,26 @@ class Product:
     def __repr__(self):
         return self.handle
 
-    def escape_sql_values(values):
-        new_values = []
-        for value in values:
-            if type(value).__name__ == 'str':
-                new_values.append(value.replace('\"','\\\"'))
-            else:
-                new_values.append(value)
-        return new_values
-
     def get_tags(self):
         "Returns a list containing each tag"
         return self.tags.split(", ")
 
+    def normalize_tags(tags):
+        "Returns the set of lowercased tags in a comma separated tags string, as they're stored in product_tags"
+        if not tags:
+            return frozenset()
+        return frozenset(tag.strip().lower() for tag in tags.split(',') if tag.strip())
+
+    def get_tag_set(self):
+        "Returns the product's normalized tags, cached until self.tags changes"
+        tags, tag_set = self.__tag_set
+        if tags is not self.tags:
+            tag_set = Product.normalize_tags(self.tags)
+            self.__tag_set = (self.tags, tag_set)
+        return tag_set
+
     def set_tags(self, tags):
-        "Stores a list of tags into a product object"
+        "Stores a list of tags into a product object, product_tags is brought in line when the product is saved"
         tags_str = ''
         for i, tag in enumerate(tags):
             if i < len(tags) - 1:
@@ -997,6 +1823,7 @@ class Product:
             else:
                 tags_str += "%s" %(tag)
         self.tags = tags_str
+        self.__tag_set = (tags_str, Product.normalize_tags(tags_str))
 
     def set_g_age_group(self, g_age_group):
         if g_age_group.lower() in googleDefs.age_group:
@@ -1029,112 +1856,365 @@ class Product:
             logging.warn(bad_log_str)
 
     def has_tag(self, tag):
-        tags = [tag.lower() for tag in self.get_tags()]
-        if tag.lower() in tags:
-            return True
-        else:
-            return False
+        return tag.strip().lower() in self.get_tag_set()
+
 
+    def __get_upsert_columns():
+        columns = [sql_field for sql_field in Product.fields.values() if sql_field != 'products_id']
+        # Saved with the product so collection_bulk_import can tell which products changed since it last ran
+        columns.append('products_conditions_fingerprint')
+        return columns
 
-    def __get_save_statement(self, statement_type, ignore=['products_id']):
+    def __get_upsert_statement():
         """
-        Returns tuple containing sql statement and formatter.
-        Must be given either 'update' or 'insert' statement type.
-        sql column names should be added as an argument to the ignore list keyword.
-        products_id is ignored by default
+        Returns a parameterized statement that inserts a product, or updates the product with the same unique handle.
+        After executing it, the backend's upserted_id returns the product's id whether the row was inserted or updated.
+        Urls are set by collection imports, so re-importing a product leaves its stored url alone
         """
-        sql_fields = {}
-
-        # Get each sql field and its value
-        for object_field, sql_field in self.fields.items():
-            sql_fields[sql_field] = self.__getattribute__(object_field)
-
-        if statement_type == 'update':
-            update_statement = 'UPDATE products\nSET %s\nWHERE products_handle = "%s";'
-            fragment = ''; values = []
-            for i, unpacked in enumerate(sql_fields.items()):
-                field = unpacked[0]; val = unpacked[1]
-                if field not in ignore:
-                    if i < len(sql_fields) - 1:
-                        fragment += '%s = "%s", ' % (field, self.sql_field_type[field])
-                        values.append(val)
-                    else:
-                        fragment += '%s = "%s" ' % (field, self.sql_field_type[field])
-                        values.append(val)
-            update_statement = update_statement % (fragment, self.handle)
-            values = Product.escape_sql_values(values)
-            return update_statement % tuple(values)
-
-        elif statement_type == 'insert':
-            insert_statement = 'INSERT INTO products (%s) VALUES (%s);'
-            first_fragment = ''; second_fragment = ''; values = []
-            for i, unpacked in enumerate(sql_fields.items()):
-                field = unpacked[0]; val = unpacked[1]
-                if field not in ignore:
-                    if i < len(sql_fields) - 1:
-                        first_fragment += '%s, ' % (field)
-                        second_fragment += '"%s", ' % (self.sql_field_type[field])
-                        values.append(val)
-                    else:
-                        first_fragment += '%s' % (field)
-                        second_fragment += '"%s"' % (self.sql_field_type[field])
-                        values.append(val)
-            insert_statement = insert_statement % (first_fragment, second_fragment)
-            values = Product.escape_sql_values(values)
-            return insert_statement % tuple(values)
-        else:
-            raise ValueError('__GetSaveStatement received invalid statement_type')
+        return DB.get_backend().upsert_statement('products', Product.__get_upsert_columns(), 'products_handle', 'products_id',
+                                                 insert_only=['products_url'])
+
+    def __get_upsert_values(self):
+        "Returns the product's values in the column order used by __get_upsert_statement"
+        columns = Product.__get_upsert_columns()
+        sql_fields = dict((sql_field, object_field) for object_field, sql_field in self.fields.items())
+        return [getattr(self, sql_fields[column]) for column in columns[:-1]] + [self.get_conditions_fingerprint()]
+
+    def get_conditions_fingerprint(self):
+        "Returns a SHA-1 hex digest of the values collection conditions match: title, vendor and tags, all lowercased"
+        canonical = '\n'.join([self.title.lower(), (self.vendor or '').lower(), ','.join(sorted(self.get_tag_set()))])
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def get_changed_products(fields=None):
+        """
+        Returns products whose title, vendor or tags changed, or that were added, since
+        collection memberships were last evaluated for them by collection_bulk_import.
+        Only the given fields are loaded if fields is a list of field names
+        """
+        with DB() as con:
+            cur = DB.dict_cursor(con)
+            cur.execute("""
+            SELECT %s FROM products
+            WHERE products_evaluated_fingerprint IS NULL OR products_conditions_fingerprint IS NULL
+            OR products_evaluated_fingerprint <> products_conditions_fingerprint
+            """ %(Product.get_select_columns(fields)))
+            return [Product.from_row(row) for row in cur.fetchall()]
+
+    def mark_evaluated(products, cur):
+        "Records that collection memberships are up to date with each product's title, vendor and tags"
+        s = 'UPDATE products SET products_conditions_fingerprint = %s, products_evaluated_fingerprint = %s WHERE products_id = %s'
+        try:
+            values = []
+            for product in products:
+                fingerprint = product.get_conditions_fingerprint()
+                values.append((fingerprint, fingerprint, product.id))
+            cur.executemany(s, values)
+        except storage.Error as e:
+            print("Problem while marking products evaluated in database")
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+
+    def mark_saved(self, *fields):
+        "Records the current values of the given fields, or of every field, as the values stored in the database"
+        if self.__saved_values is None:
+            if fields:
+                # Nothing is known about the other fields, the product still needs a full save
+                return
+            self.__saved_values = {}
+        for field in fields or Product.fields:
+            if field in self.__dict__:
+                self.__saved_values[field] = self.__dict__[field]
+
+    def get_changed_fields(self):
+        "Returns the fields changed since the product was loaded or saved, or every field if it never was"
+        if self.__saved_values is None:
+            return list(Product.fields)
+        # Fields that haven't been loaded or assigned can't have changed
+        return [field for field in Product.fields if field != 'id' and field in self.__dict__
+                and self.__dict__[field] != self.__saved_values.get(field)]
+
+    def __get_changed_columns(self, changed):
+        "Returns an ordered dict of the column values to write for the changed fields"
+        columns = OrderedDict((Product.fields[field], getattr(self, field)) for field in changed)
+        if set(changed) & set(['title', 'vendor', 'tags']):
+            columns['products_conditions_fingerprint'] = self.get_conditions_fingerprint()
+        return columns
 
     def save(self, cur):
+        """
+        Inserts the product, or updates it if a product with the same handle exists, in a single statement.
+        A product loaded from the database only has its changed fields written, and isn't written at all without changes.
+        While a WriteBuffer is active, changes to loaded products are queued in it instead
+        """
+        changed = self.get_changed_fields()
+        if not changed:
+            logging.debug('Product "%s" has no changes, skipping save' %(self.handle))
+            return
+
+        full_save = self.__saved_values is None or self.id in ('', None)
+        buffer = WriteBuffer.current()
+        if buffer is not None and not full_save:
+            buffer.add(self, self.__get_changed_columns(changed), cur)
+            self.mark_saved()
+            return
+
+        s = None
         try:
-            # Update
-            if Product.get_product(self.handle):
-                logging.debug('Updating product "%s" in DB' %(self.handle))
-                s = self.__get_save_statement('update', ignore=['products_id', 'products_handle'])
-                cur.execute(s)
-            # Insert
+            logging.debug('Saving product "%s" in DB' %(self.handle))
+            if full_save:
+                s = Product.__get_upsert_statement()
+                cur.execute(s, self.__get_upsert_values())
+                self.id = DB.get_backend().upserted_id(cur)
             else:
-                logging.debug('inserting product "%s" in DB' %(self.handle))
-                s = self.__get_save_statement('insert')
-                cur.execute(s)
-        except mysql.Error as e:
+                columns = self.__get_changed_columns(changed)
+                s = 'UPDATE products SET %s WHERE products_id = %%s' % (', '.join(['%s = %%s' % (column) for column in columns]))
+                cur.execute(s, list(columns.values()) + [self.id])
+        except storage.Error as e:
             print("Problem while saving a product to database")
             #print("Error %d: %s" % (e.args[0], e.args[1]))
             print(e)
             print(cur)
             raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+        if full_save or 'tags' in changed:
+            Product.save_tags([self], cur)
+        self.mark_saved()
+
+    def bulk_save(products, con, batch_size=None):
+        """
+        Saves a list of products using multi-row executemany upserts, committing once per batch.
+        batch_size defaults to config.db_write_batch_size. Product ids are not set on the objects
+        """
+        if batch_size is None:
+            batch_size = getattr(config, 'db_write_batch_size', 1000)
+
+        s = Product.__get_upsert_statement()
+        cur = con.cursor()
+        for i in range(0, len(products), batch_size):
+            batch = products[i:i + batch_size]
+            try:
+                cur.executemany(s, [product.__get_upsert_values() for product in batch])
+                Product.save_tags(batch, cur, batch_size, handles=True)
+                con.commit()
+                logging.debug('Saved batch of %d products in DB' %(len(batch)))
+            except storage.Error as e:
+                print("Problem while saving a batch of products to database")
+                print(e)
+                raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+
+    def save_tags(products, cur, chunk_size=1000, handles=False):
+        """
+        Replaces the product_tags rows of each product with its normalized tags, chunk_size rows per statement.
+        Products are matched by id, or by handle if handles=True for products saved without setting their ids
+        """
+        s = None
+        try:
+            if handles:
+                ids = {}
+                for i in range(0, len(products), chunk_size):
+                    chunk = [product.handle for product in products[i:i + chunk_size]]
+                    s = "SELECT products_handle, products_id FROM products WHERE products_handle IN (%s)" % (', '.join(['%s'] * len(chunk)))
+                    cur.execute(s, chunk)
+                    ids.update(cur.fetchall())
+                product_ids = [(ids[product.handle], product) for product in products if product.handle in ids]
+            else:
+                product_ids = [(product.id, product) for product in products if product.id not in ('', None)]
+
+            for i in range(0, len(product_ids), chunk_size):
+                chunk = [products_id for products_id, product in product_ids[i:i + chunk_size]]
+                s = "DELETE FROM product_tags WHERE products_id IN (%s)" % (', '.join(['%s'] * len(chunk)))
+                cur.execute(s, chunk)
+
+            s = "INSERT INTO product_tags"
+            DB.insert_rows(cur, 'product_tags', ['products_id', 'tag'],
+                           [(products_id, tag) for products_id, product in product_ids for tag in sorted(product.get_tag_set())],
+                           chunk_size=chunk_size)
+        except storage.Error as e:
+            print("Problem while saving product tags to database")
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+
+    # Fields set_field_for_all can set. Title, vendor and tags also have to update product_tags and the
+    # conditions fingerprint, so they're only written through save
+    bulk_fields = ['url', 'g_age_group', 'g_color', 'g_product_category', 'g_gender']
+
+    def update_field(field, value, product_ids=None):
+        """
+        Runs set_field_for_all on its own connection and commits it. While an active WriteBuffer has changes
+        queued for a transaction that's still open, it runs on that transaction's cursor instead and is
+        committed with it, rather than waiting on its locks. Returns the number of rows changed
+        """
+        cur = WriteBuffer.owner_cursor()
+        if cur is not None:
+            return Product.set_field_for_all(field, value, cur, product_ids=product_ids)
+        with DB() as con:
+            rowcount = Product.set_field_for_all(field, value, con.cursor(), product_ids=product_ids)
+            con.commit()
+        return rowcount
+
+    def set_field_for_all(field, value, cur, product_ids=None, chunk_size=1000):
+        """
+        Sets a field to value for every product with a single UPDATE, or for the products with the given ids,
+        chunk_size ids per statement. Only fields in bulk_fields can be set.
+        Returns the number of rows changed. Products held by the active session are updated too
+        """
+        if field not in Product.bulk_fields:
+            raise ValueError("Can't set field '%s' for products, expected one of %s" %(field, ', '.join(Product.bulk_fields)))
+
+        s = 'UPDATE products SET %s = %%s' %(Product.fields[field])
+        statements = []
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            for i in range(0, len(product_ids), chunk_size):
+                chunk = product_ids[i:i + chunk_size]
+                statements.append((s + ' WHERE products_id IN (%s)' % (', '.join(['%s'] * len(chunk))), [value] + chunk))
+        else:
+            statements.append((s, [value]))
+
+        # Queued saves are older than this update, write them first so they don't overwrite it when flushed
+        WriteBuffer.flush_current(cur)
+        rowcount = 0
+        try:
+            for s, args in statements:
+                rowcount += cur.execute(s, args)
+        except storage.Error as e:
+            print("Problem while setting %s for products in database" %(field))
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+
+        if product_ids is not None:
+            for products_id in product_ids:
+                product = Session.lookup(Product, 'id', products_id)
+                if product is not None:
+                    setattr(product, field, value)
+                    product.mark_saved(field)
+        else:
+            for product in Session.loaded(Product):
+                setattr(product, field, value)
+                product.mark_saved(field)
+        return rowcount
+
+    def save_urls(products, cur):
+        "Saves just the url of each product, with one executemany"
+        s = 'UPDATE products SET products_url = %s WHERE products_id = %s'
+        products = [product for product in products if product.id not in ('', None)]
+        WriteBuffer.flush_current(cur)
+        try:
+            cur.executemany(s, [(product.url, product.id) for product in products])
+        except storage.Error as e:
+            print("Problem while saving product urls to database")
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+        for product in products:
+            product.mark_saved('url')
 
     def get_product(product_ident, **options):
-        "Gets a product based on its handle, can find a product based on id if id=True keyword is passed"
-        kwargs = {}
+        """
+        Gets a product based on its handle, can find a product based on id if id=True keyword is passed.
+        A fields=[...] keyword loads only those fields, see get_select_columns
+        """
+        product = Session.lookup(Product, 'id' if options.get('id') == True else 'handle', product_ident)
+        if product is not None:
+            return product
+
+        columns = Product.get_select_columns(options.get('fields'))
         with DB() as con:
-            cur = con.cursor(mysql.cursors.DictCursor)
+            cur = DB.dict_cursor(con)
             if options.get('id') == True:
                 # Select product by ID
-                sql_statement = "select * from products where products_id=%d" % (product_ident)
+                sql_statement = "select %s from products where products_id=%%s" %(columns)
             elif options.get('handle') == True:
                 # Select product by handle
-                sql_statement = "select * from products where products_handle='%s'" % (product_ident)
+                sql_statement = "select %s from products where products_handle=%%s" %(columns)
             else:
                 # Default behavior, Select product by handle
-                sql_statement = "select * from products where products_handle='%s'" % (product_ident)
-            cur.execute(sql_statement)
+                sql_statement = "select %s from products where products_handle=%%s" %(columns)
+            cur.execute(sql_statement, (product_ident,))
             result = cur.fetchone()
 
             # Return NoneType if product not found
             if not result:
                 return None
 
-            # Finds all columns that exist in products table and matches them up with object definition
-            t_columns = []
-            for column in cur.description:
-                t_columns.append(column[0])
+            return Product.from_row(result)
+
+    def get_products(ids=None, handles=None, chunk_size=1000, fields=None):
+        """
+        Gets a list of products given a list of ids or a list of handles.
+        Products are fetched with one 'IN (...)' query per chunk_size keys rather than one query per product.
+        Products are returned in the order their keys were given, keys that aren't found are left out.
+        Only the given fields are loaded if fields is a list of field names
+        """
+        if ids is not None:
+            column = 'products_id'; key_name = 'id'; keys = list(ids)
+        elif handles is not None:
+            column = 'products_handle'; key_name = 'handle'; keys = list(handles)
+        else:
+            raise ValueError("get_products requires either ids or handles")
 
-            for p_attribute, p_column in Product.fields.items():
-                if p_column in t_columns:
-                    kwargs[p_attribute] = result[p_column]
+        found = {}
+        for key in dict.fromkeys(keys):
+            product = Session.lookup(Product, key_name, key)
+            if product is not None:
+                found[key] = product
 
-            return Product(**kwargs)
+        unique_keys = [key for key in dict.fromkeys(keys) if key not in found]
+        with DB() as con:
+            cur = DB.dict_cursor(con)
+            for i in range(0, len(unique_keys), chunk_size):
+                chunk = unique_keys[i:i + chunk_size]
+                sql_statement = "select %s from products where %s in (%s)" % (Product.get_select_columns(fields), column, ', '.join(['%s'] * len(chunk)))
+                cur.execute(sql_statement, chunk)
+                for row in cur.fetchall():
+                    found[row[column]] = Product.from_row(row)
+        return [found[key] for key in keys if key in found]
+
+    def from_row(row, register=True):
+        """
+        Builds a product from a products table row, given as a dict keyed by column name.
+        With register=False the product isn't added to the active session, but the session's object is still
+        returned if it already holds the product
+        """
+        kwargs = {}
+        # Finds all columns that exist in the row and matches them up with object definition
+        for p_attribute, p_column in Product.fields.items():
+            if p_column in row:
+                kwargs[p_attribute] = row[p_column]
+        kwargs.setdefault('title', '')
+        product = Product(**kwargs)
+        # Fields left out of the row are loaded when they're first read, see __getattr__
+        for p_attribute, p_column in Product.fields.items():
+            if p_column not in row:
+                del product.__dict__[p_attribute]
+        product.mark_saved()
+        if not register:
+            existing = Session.lookup(Product, 'id', product.id)
+            return product if existing is None else existing
+        return Session.register(product)
+
+    def __getattr__(self, name):
+        "Loads the fields left out when the product was loaded, the first time one of them is read"
+        if name not in Product.fields or '_Product__saved_values' not in self.__dict__ or self.__dict__.get('id') in ('', None):
+            raise AttributeError("'Product' object has no attribute '%s'" %(name))
+        self.__load_fields()
+        return self.__dict__[name]
+
+    def __load_fields(self):
+        "Loads every field that wasn't loaded with the product, in one query"
+        missing = [field for field in Product.fields if field not in self.__dict__]
+        with DB() as con:
+            cur = DB.dict_cursor(con)
+            cur.execute("select %s from products where products_id=%%s" % (', '.join(Product.fields[field] for field in missing)), (self.id,))
+            row = cur.fetchone()
+        if row is None:
+            raise AttributeError("Product %s no longer exists, couldn't load %s" %(self.handle, ', '.join(missing)))
+
+        logging.debug('Loaded fields %s for product %s' %(', '.join(missing), self.handle))
+        for field in missing:
+            value = row[Product.fields[field]]
+            if field == 'price' and value is not None:
+                value = float(value)
+            self.__dict__[field] = value
+        self.mark_saved(*missing)
 
     def color_list_to_string(colors):
         color_str = ''
@@ -1223,6 +2303,7 @@ class Collection:
     def __init__(self, title=None, **kwargs):
         # FIX ME.. just use Collection.get_collection instead of this silliness
         self.products = []
+        self.conditions = []
         if kwargs.get('handle'):
             self.handle = kwargs.get('handle')
         else:
@@ -1234,76 +2315,112 @@ class Collection:
         return self.handle
 
 
-    def __get_collection_handles():
+    def get_collections(fields=None):
+        """
+        Returns every collection with its products using three queries: collections, their product memberships,
+        and the products themselves. Collections that share a product share the same Product object.
+        Only the given product fields are loaded if fields is a list of field names
+        """
         with DB() as con:
             cur = con.cursor()
-            statement = "select collections_handle from collections"
-            cur.execute(statement)
-            handles = [x[0] for x in cur.fetchall()]
-            return handles
+            cur.execute("select collections_id, collections_handle, collections_title from collections order by collections_id")
+            collection_rows = cur.fetchall()
 
+            cur.execute("select collections_id, products_id from products_collections order by collections_id, products_id")
+            membership_rows = cur.fetchall()
+
+            cur = DB.dict_cursor(con)
+            cur.execute("select %s from products where products_id in (select products_id from products_collections)" %(Product.get_select_columns(fields)))
+            products = {}
+            for row in cur.fetchall():
+                product = Product.from_row(row)
+                products[product.id] = product
 
-    def get_collections():
         collections = []
-        handles = Collection.__get_collection_handles()
-        for handle in handles:
-            collections.append(Collection.get_collection(handle))
+        collections_by_id = {}
+        for id, handle, title in collection_rows:
+            c = Session.lookup(Collection, 'id', id)
+            if c is None:
+                c = Collection(handle=handle)
+                c.id = id
+                c.title = title
+                Session.register(c)
+                collections_by_id[id] = c
+            collections.append(c)
+
+        # Collections already held by the session keep their product lists
+        for collections_id, products_id in membership_rows:
+            if collections_id in collections_by_id and products_id in products:
+                collections_by_id[collections_id].products.append(products[products_id])
+
         return collections
 
 
     def get_collection(collection_handle):
+        c = Session.lookup(Collection, 'handle', collection_handle)
+        if c is not None:
+            return c
+
         with DB() as con:
             cur = con.cursor()
             c = Collection(handle=collection_handle)
-            statement = "select collections_id, collections_title from collections where collections_handle = '%s'"
-            cur.execute(statement %(collection_handle))
+            statement = "select collections_id, collections_title from collections where collections_handle = %s"
+            cur.execute(statement, (collection_handle,))
             row = cur.fetchone()
             id = row[0]; title = row[1]
 
-            c.id = id
-            c.title = title
-            c.__gather_products()
-            return c
+        c.id = id
+        c.title = title
+        c.__gather_products()
+        return Session.register(c)
+
+    def __set_field_for_products(self, field, value):
+        """
+        Sets a field to value for the collection's products with a single UPDATE by product id,
+        and on the collection's product objects. Returns the number of rows changed
+        """
+        product_ids = [product.id for product in self.products if product.id not in ('', None)]
+        rowcount = Product.update_field(field, value, product_ids=product_ids)
+        for product in self.products:
+            setattr(product, field, value)
+            product.mark_saved(field)
+        logging.debug('Set %s "%s" for %d products in collection %s' %(field, value, rowcount, self.handle))
+        return rowcount
 
     def set_g_age_group(self, g_age_group):
-        "Propogates a g_age_group to all of a collection's products and saves them to db"
+        "Propogates a g_age_group to all of a collection's products and saves them to db, returns the number of products changed"
         logging.info('- Setting g_age_group "%s" for Collection "%s"' %(g_age_group, self.handle))
         print('Setting g_age_group "%s" for Collection "%s"...'%(g_age_group, self.handle))
 
-        with DB() as con:
-            cur = con.cursor()
-            if g_age_group.lower() in googleDefs.age_group:
-                for product in self.products:
-                    product.set_g_age_group(g_age_group)
-                    product.save(cur)
-            con.commit()
+        if g_age_group.lower() in googleDefs.age_group:
+            return self.__set_field_for_products('g_age_group', g_age_group)
+        else:
+            bad_log_str = 'Attempted to set collection %s to malformed g_age_group' % (self.handle)
+            logging.warn(bad_log_str)
+            return 0
 
     def set_g_gender(self, g_gender):
-        "Propogates a g_gender to all of a collection's products and saves them to db"
+        "Propogates a g_gender to all of a collection's products and saves them to db, returns the number of products changed"
         logging.info('- Setting g_gender "%s" for Collection "%s"'%(g_gender, self.handle))
         print('Setting g_gender "%s" for Collection "%s"...'%(g_gender, self.handle))
-        with DB() as con:
-            cur = con.cursor()
-            if g_gender.lower() in googleDefs.gender:
-                for product in self.products:
-                    product.set_g_gender(g_gender)
-                    product.save(cur)
-            con.commit()
+
+        if g_gender.lower() in googleDefs.gender:
+            return self.__set_field_for_products('g_gender', g_gender)
+        else:
+            bad_log_str = 'Attempted to set collection %s to malformed g_gender' % (self.handle)
+            logging.warn(bad_log_str)
+            return 0
 
     def set_g_product_category(self, g_product_category):
-        "Propogates a g_product_category to all of a collection's products and saves them to db"
-        with DB() as con:
-            cur = con.cursor()
-            if GoogleFeed.verify_g_product_category(g_product_category):
-                logging.info('- Setting g_product_category "%s" for Collection "%s"'%(g_product_category, self.handle))
-                print('Setting g_product_category "%s" for Collection "%s"...'%(g_product_category, self.handle)) 
-                for product in self.products:
-                    product.set_g_product_category(g_product_category)
-                    product.save(cur)
-                con.commit()
-            else:
-                bad_log_str = 'Attempted to set collection %s to malformed g_product_category' % (self.handle)
-                logging.warn(bad_log_str)
+        "Propogates a g_product_category to all of a collection's products and saves them to db, returns the number of products changed"
+        if GoogleFeed.verify_g_product_category(g_product_category):
+            logging.info('- Setting g_product_category "%s" for Collection "%s"'%(g_product_category, self.handle))
+            print('Setting g_product_category "%s" for Collection "%s"...'%(g_product_category, self.handle))
+            return self.__set_field_for_products('g_product_category', g_product_category)
+        else:
+            bad_log_str = 'Attempted to set collection %s to malformed g_product_category' % (self.handle)
+            logging.warn(bad_log_str)
+            return 0
 
     def scrape_bold_product_options(self):
         "Scrapes options for all products in collection and inserts them into the database"
@@ -1323,10 +2440,10 @@ class Collection:
                 raise ValueError("Attempted to instantiate collection with malformed condition")
 
         # Build SQL statement
-        sql_statement = self.__build_statement_from_conditions(self.conditions)
+        sql_statement, sql_args = self.__build_statement_from_conditions(self.conditions)
 
         # Get product handle list
-        product_handles = self.__get_product_handles(sql_statement)
+        product_handles = self.__get_product_handles(sql_statement, sql_args)
 
         # Build product List
         self.products = self.__get_products_from_handles(product_handles)
@@ -1336,25 +2453,27 @@ class Collection:
     def get_products(self):
             return self.products
 
+    def get_product_url(self, product):
+        return 'https://%s/collections/%s/products/%s' % (config.domain_name, self.handle, product.handle)
+
     def generate_urls(self, cur):
         "Used to generate urls for products within a collection and save them in database"
         for product in self.products:
-            url = 'https://%s/collections/%s/products/%s' % (config.domain_name, self.handle, product.handle)
-            product.url = url
-            product.save(cur)
+            product.url = self.get_product_url(product)
+        Product.save_urls(self.products, cur)
 
     def __gather_products(self):
         "Used to build a products list for a collection that exists in the database"
         with DB() as con:
             cur = con.cursor()
-            statement = "SELECT p.products_id FROM (products AS p) LEFT JOIN products_collections AS pc ON p.products_id=pc.products_id RIGHT JOIN collections AS c ON pc.collections_id=c.collections_id WHERE c.collections_handle = '%s' AND p.products_id IS NOT NULL;" %(self.handle)
-            cur.execute(statement)
+            statement = "SELECT pc.products_id FROM products_collections AS pc JOIN collections AS c ON pc.collections_id=c.collections_id WHERE c.collections_handle = %s;"
+            cur.execute(statement, (self.handle,))
             rows = cur.fetchall()
-            if rows:
-                product_ids = [row[0] for row in rows]
-                self.products = self.__get_products_from_ids(product_ids)
-            else:
-                pass
+        if rows:
+            product_ids = [row[0] for row in rows]
+            self.products = self.__get_products_from_ids(product_ids)
+        else:
+            pass
             # get_collection_id_statement = "select collections_id from collections where collections_handle = '%s'"
             # get_products_statement = "select products_id from products_collections where collections_id = '%s'"
             # product_ids = []
@@ -1373,65 +2492,72 @@ class Collection:
 
 
     def __get_products_from_ids(self, product_ids):
-        products = []
-        for product_id in product_ids:
-            products.append(Product.get_product(product_id, id=True))
-        return products
+        return Product.get_products(ids=product_ids)
 
 
     def __get_products_from_handles(self, product_handles):
-        "Feeds product handles into Product's get_product method"
-        products = []
-        for product_handle in product_handles:
-            products.append(Product.get_product(product_handle))
-            logging.debug('Collection %s added product %s' %(self.handle, product_handle))
+        "Feeds product handles into Product's get_products method"
+        products = Product.get_products(handles=product_handles)
+        for product in products:
+            logging.debug('Collection %s added product %s' %(self.handle, product.handle))
         return products
 
-    def __get_product_handles(self, sql_statement):
-        "Used with the constructed SQL statement to return a filtered list of product handles"
+    def __get_product_handles(self, sql_statement, sql_args):
+        "Used with the constructed SQL statement and its parameters to return a filtered list of product handles"
         with DB() as con:
             product_handles = []
             cur = con.cursor()
-            cur.execute(sql_statement)
+            cur.execute(sql_statement, sql_args)
             for product in cur.fetchall():
                 product_handles.append(product[0])
             return product_handles
 
     def __build_statement_fragment(self, condition):
-        "Returns an sql statement fragment for use in the __build_statement_from_conditions method"
+        "Returns an sql statement fragment and its parameter for use in the __build_statement_from_conditions method"
         sql_statement_fragment= ''
         variable = condition[0]; relation = condition[1]; value = condition[2]
-        sql_tag_find_regex = "'(^\ *|,\ )%s(,\ *|\ *$)'" % (value)
 
         if variable == 'tag':
+            # Tags are matched with the indexed product_tags table, which stores them lowercased
+            value = value.strip().lower()
             if relation == 'equals':
-                sql_statement_fragment = "products_tags REGEXP %s" % (sql_tag_find_regex)
+                sql_statement_fragment = "products_id IN (SELECT products_id FROM product_tags WHERE tag = %s)"
             if relation == 'does not contain':
-                sql_statement_fragment = "products_tags REGEXP %s" % (sql_tag_find_regex)
+                sql_statement_fragment = "products_id NOT IN (SELECT products_id FROM product_tags WHERE tag = %s)"
         if variable == 'title':
+            value = '%%%s%%' % (value)
             if relation == 'equals':
-                sql_statement_fragment = "products_title LIKE '%%%s%%'" % (value)
+                sql_statement_fragment = "products_title LIKE %s"
             if relation == 'does not contain':
-                sql_statement_fragment = "products_title NOT LIKE '%%%s%%'" % (value)
+                sql_statement_fragment = "products_title NOT LIKE %s"
         if variable == 'vendor':
+            value = '%%%s%%' % (value)
             if relation == 'equals':
-                sql_statement_fragment = "products_vendor LIKE '%%%s%%'" % (value)
+                sql_statement_fragment = "products_vendor LIKE %s"
 
         if sql_statement_fragment == '':
             raise ValueError("Condition could not be processed")
         else:
-            return sql_statement_fragment
+            return sql_statement_fragment, value
 
     def __build_statement_from_conditions(self, conditions):
-        "Returns an sql_statement to match products given a condition"
+        "Returns an sql_statement to match products given a condition, and the list of its parameters"
         sql_statement = 'SELECT products_handle FROM products WHERE '
+        sql_args = []
         for i, condition in enumerate(conditions):
-            sql_statement += self.__build_statement_fragment(condition)
+            sql_statement_fragment, value = self.__build_statement_fragment(condition)
+            sql_statement += sql_statement_fragment
+            sql_args.append(value)
             if i < len(conditions) - 1:
                 sql_statement += ' AND '
             else:
                 sql_statement += ';'
-        return sql_statement
+        return sql_statement, sql_args
+
+    def get_conditions_fingerprint(self):
+        "Returns a SHA-1 hex digest of the collection's conditions, regardless of their order"
+        canonical = '\n'.join(sorted('\t'.join(condition) for condition in self.conditions))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
 
     def is_condition(condition):
         "Verifies the condition is correctly formed"
@@ -1443,31 +2569,67 @@ class Collection:
         else:
             return False
 
-    def save(self, cur):
+    def save(self, cur, chunk_size=1000):
+        """
+        Saves the collection and brings its products_collections rows in line with self.products:
+        memberships of products that left the collection are deleted and new ones inserted, chunk_size rows per statement.
+        Returns the ids of the products that left the collection
+        """
+        s = None
         try:
-            select_statement = "SELECT collections_handle FROM collections WHERE collections_handle = '%s'"
-            select_id_statement = "SELECT collections_id FROM collections WHERE collections_handle = '%s'"
-            insert_collection_statement = "INSERT INTO collections (collections_handle, collections_title) VALUES ('%s', '%s')"
-            insert_product_into_collection_statement = "INSERT INTO products_collections (products_id, collections_id) VALUES (%d, %d)"
-
-            # Check if collection exists, insert into collections table if it doesn't
-            cur.execute(select_statement %(self.handle))
-            if not cur.fetchall():
-                cur.execute(insert_collection_statement % (self.handle, self.title))
-
-            # Get ID for collection
-            cur.execute(select_id_statement %(self.handle))
-            collections_id = cur.fetchone()[0]
-
-            # Insert products into the collection
-            for product in self.products:
-                s = insert_product_into_collection_statement % (product.id, collections_id)
-                cur.execute(s)
-
-        except mysql.Error as e:
+            # Insert collection, or update its title if it exists, and get its ID
+            backend = DB.get_backend()
+            s = backend.upsert_statement('collections', ['collections_handle', 'collections_title', 'collections_conditions_fingerprint'],
+                                         'collections_handle', 'collections_id')
+            cur.execute(s, (self.handle, self.title, self.get_conditions_fingerprint()))
+            self.id = backend.upserted_id(cur)
+
+            s = "SELECT products_id FROM products_collections WHERE collections_id = %s"
+            cur.execute(s, (self.id,))
+            existing_ids = set(row[0] for row in cur.fetchall())
+            product_ids = set(product.id for product in self.products if product.id not in ('', None))
+
+            removed_ids = sorted(existing_ids - product_ids)
+            for i in range(0, len(removed_ids), chunk_size):
+                chunk = removed_ids[i:i + chunk_size]
+                s = "DELETE FROM products_collections WHERE collections_id = %%s AND products_id IN (%s)" % (', '.join(['%s'] * len(chunk)))
+                cur.execute(s, [self.id] + chunk)
+
+            added_ids = sorted(product_ids - existing_ids)
+            s = "INSERT INTO products_collections"
+            DB.insert_rows(cur, 'products_collections', ['products_id', 'collections_id'],
+                           [(products_id, self.id) for products_id in added_ids], chunk_size=chunk_size)
+
+            logging.debug('Saved collection %s: %d products added, %d removed' %(self.handle, len(added_ids), len(removed_ids)))
+            return removed_ids
+        except storage.Error as e:
             print("Problem while saving a collection to database")
-            #print("Error %d: %s" % (e.args[0], e.args[1]))
             print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
+
+    def save_memberships(self, cur, product_ids, chunk_size=1000):
+        """
+        Brings the products_collections rows of the products in product_ids in line with self.products, leaving
+        the collection's other rows alone. Used to update a saved collection for just the products that changed.
+        Returns the ids of the products in product_ids that aren't in the collection, whose rows were deleted if they had any
+        """
+        s = None
+        try:
+            member_ids = set(product.id for product in self.products) & set(product_ids)
+            removed_ids = sorted(set(product_ids) - member_ids)
+            for i in range(0, len(removed_ids), chunk_size):
+                chunk = removed_ids[i:i + chunk_size]
+                s = "DELETE FROM products_collections WHERE collections_id = %%s AND products_id IN (%s)" % (', '.join(['%s'] * len(chunk)))
+                cur.execute(s, [self.id] + chunk)
+
+            s = "INSERT INTO products_collections"
+            DB.insert_rows(cur, 'products_collections', ['products_id', 'collections_id'],
+                           [(products_id, self.id) for products_id in sorted(member_ids)], chunk_size=chunk_size, ignore=True)
+            return removed_ids
+        except storage.Error as e:
+            print("Problem while saving collection memberships to database")
+            print(e)
+            raise ValueError('SQL ERROR: %s, \nstatement: %s' %(e, s))
 
     def bulk_process_g_colors(self):
         with DB() as con:
@@ -1477,15 +2639,285 @@ class Collection:
                 product.save(cur)
             con.commit()
 
+class TrigramIndex:
+    """
+    Indexes a text field of a list of products by the three character substrings of its lowercased value.
+    Products containing a substring must contain each of its trigrams, so intersecting their postings
+    narrows a substring search down to a few candidates, which are then verified
+
+        index = TrigramIndex(products, 'title')
+        vests = index.search('vest')
+    """
+    def __init__(self, products, field):
+        self.products = products
+        self.field = field
+        # Maps each trigram to the set of positions in products of the products containing it
+        self.postings = {}
+        for i, product in enumerate(products):
+            for trigram in TrigramIndex.get_trigrams(self.get_text(product)):
+                self.postings.setdefault(trigram, set()).add(i)
+
+    def get_trigrams(text):
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def get_text(self, product):
+        return (getattr(product, self.field) or '').lower()
+
+    def get_candidates(self, value):
+        """
+        Returns the set of positions of products whose field may contain value,
+        or None if value is shorter than a trigram and can't narrow the search
+        """
+        trigrams = TrigramIndex.get_trigrams(value.lower())
+        if not trigrams:
+            return None
+        postings = sorted((self.postings.get(trigram, set()) for trigram in trigrams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        return candidates
+
+    def search(self, value):
+        "Returns the products whose field contains value, case insensitively, in their original order"
+        candidates = self.get_candidates(value)
+        if candidates is None:
+            candidates = range(len(self.products))
+        value = value.lower()
+        return [self.products[i] for i in sorted(candidates) if value in self.get_text(self.products[i])]
+
+class CollectionRuleEngine:
+    """
+    Evaluates the conditions of many collections over the whole catalog in memory, loading it once
+    instead of running one SQL scan per collection. Conditions are compiled into predicates that behave like the
+    SQL Collection.process_conditions builds: tags match whole normalized tags, titles and vendors match
+    substrings, all case insensitively. A product belongs to a collection when it satisfies all of its conditions.
+    Title and vendor substring conditions are looked up in trigram indexes, so only candidate products are checked.
+
+        engine = CollectionRuleEngine()
+        engine.add(collection, ('tag', 'equals', 'formal'), ('title', 'does not contain', 'vest'))
+        memberships = engine.evaluate()
+    """
+    # Product fields conditions match, and the url collection_bulk_import writes
+    fields = ['title', 'vendor', 'tags', 'url']
+
+    def __init__(self, products=None):
+        "Evaluates over products, or the whole catalog loaded in one query without descriptions if products isn't given"
+        if products is None:
+            products = Product.get_all_products(fields=CollectionRuleEngine.fields)
+        self.products = products
+        self.rules = []
+        # Trigram indexes by field, built the first time a condition on the field is evaluated
+        self.indexes = {}
+
+    def compile_condition(condition):
+        "Returns a function accepting a product and returning whether it satisfies condition"
+        variable = condition[0]; relation = condition[1]; value = condition[2].lower()
+
+        if variable == 'tag':
+            value = value.strip()
+            if relation == 'equals':
+                return lambda product: value in product.get_tag_set()
+            if relation == 'does not contain':
+                return lambda product: value not in product.get_tag_set()
+        if variable == 'title':
+            if relation == 'equals':
+                return lambda product: value in product.title.lower()
+            if relation == 'does not contain':
+                return lambda product: value not in product.title.lower()
+        if variable == 'vendor':
+            if relation == 'equals':
+                return lambda product: product.vendor is not None and value in product.vendor.lower()
+
+        raise ValueError("Condition could not be processed")
+
+    def add(self, collection, *conditions):
+        "Adds a collection to be evaluated with the given conditions"
+        for condition in conditions:
+            if not Collection.is_condition(condition):
+                raise ValueError("Attempted to instantiate collection with malformed condition")
+        predicates = [CollectionRuleEngine.compile_condition(condition) for condition in conditions]
+        collection.conditions = list(conditions)
+        self.rules.append((collection, predicates))
+
+    def get_index(self, field):
+        if field not in self.indexes:
+            self.indexes[field] = TrigramIndex(self.products, field)
+        return self.indexes[field]
+
+    def get_candidates(self, conditions):
+        """
+        Returns the set of positions of products that may satisfy every condition, narrowed with the trigram
+        indexes of title and vendor substring conditions, or None if none of the conditions can narrow them
+        """
+        candidates = None
+        for variable, relation, value in conditions:
+            if variable in ('title', 'vendor') and relation == 'equals':
+                matches = self.get_index(variable).get_candidates(value)
+                if matches is not None:
+                    candidates = matches if candidates is None else candidates & matches
+        return candidates
+
+    def evaluate(self):
+        """
+        Evaluates every collection over the catalog, sets each collection's products,
+        and returns a dict mapping each collection to the set of its product ids
+        """
+        memberships = {}
+        for collection, predicates in self.rules:
+            candidates = self.get_candidates(collection.conditions)
+            if candidates is None:
+                products = self.products
+            else:
+                products = [self.products[i] for i in sorted(candidates)]
+            products = [product for product in products if all(predicate(product) for predicate in predicates)]
+
+            collection.products = products
+            collection.product_count = len(products)
+            memberships[collection] = set(product.id for product in products)
+            logging.debug('Collection %s matched %d products' %(collection.handle, len(products)))
+        return memberships
+
+class AttributeRules:
+    """
+    Assigns google attributes to products from an ordered list of rules, resolved in memory over the whole catalog.
+    Each rule matches every product, the products of matching collections, or the products satisfying a predicate,
+    and sets attribute values on them. Later rules take precedence, as if each rule were applied in turn, but only
+    the final values are written, with one UPDATE per attribute value for the products whose value changes.
+
+        rules = AttributeRules()
+        rules.for_all(g_age_group='adult', g_gender='male')
+        rules.for_collections(lambda collection: 'hats' in collection.handle, g_product_category='Apparel & Accessories > Clothing Accessories > Hats')
+        rules.for_collections(get_handle("Boys Vests and Ties"), g_age_group='kids')
+        rules.for_products(lambda product: product.has_tag('womens'), g_gender='female')
+        rules.apply()
+    """
+    attributes = ['g_age_group', 'g_gender', 'g_product_category', 'g_color']
+
+    def __init__(self):
+        # Rules in order, each a tuple of kind, matcher and a dict of attribute values
+        self.rules = []
+
+    def verify_value(attribute, value):
+        "Raises ValueError unless value can be assigned to attribute"
+        if attribute == 'g_age_group':
+            valid = value.lower() in googleDefs.age_group
+        elif attribute == 'g_gender':
+            valid = value.lower() in googleDefs.gender
+        elif attribute == 'g_product_category':
+            valid = GoogleFeed.verify_g_product_category(value)
+        elif attribute == 'g_color':
+            valid = isinstance(value, str)
+        else:
+            raise ValueError("Attribute rules can't set '%s', expected one of %s" %(attribute, ', '.join(AttributeRules.attributes)))
+        if not valid:
+            raise ValueError("Malformed %s in attribute rule: %s" %(attribute, value))
+
+    def __add(self, kind, matcher, values):
+        if not values:
+            raise ValueError("Attribute rule sets no attributes")
+        for attribute, value in values.items():
+            AttributeRules.verify_value(attribute, value)
+        self.rules.append((kind, matcher, values))
+        return self
+
+    def for_all(self, **values):
+        "Adds a rule setting values for every product"
+        return self.__add('all', None, values)
+
+    def for_collections(self, matcher, **values):
+        """
+        Adds a rule setting values for the products of matching collections. matcher is a collection handle,
+        a list of handles or collections, or a function accepting a collection and returning whether it matches
+        """
+        if isinstance(matcher, str):
+            handles = set([matcher])
+            matcher = lambda collection: collection.handle in handles
+        elif not callable(matcher):
+            handles = set(item.handle if isinstance(item, Collection) else item for item in matcher)
+            matcher = lambda collection: collection.handle in handles
+        return self.__add('collections', matcher, values)
+
+    def for_products(self, predicate, **values):
+        "Adds a rule setting values for every product predicate returns True for"
+        return self.__add('products', predicate, values)
+
+    def __load_collections(self, products):
+        "Returns every collection, with products taken from the given dict of products by id"
+        with DB() as con:
+            cur = con.cursor()
+            cur.execute("select collections_id, collections_handle, collections_title from collections order by collections_id")
+            collections = {}
+            for collections_id, handle, title in cur.fetchall():
+                collection = Collection(handle=handle)
+                collection.id = collections_id
+                collection.title = title
+                collections[collections_id] = collection
+
+            cur.execute("select collections_id, products_id from products_collections order by collections_id, products_id")
+            for collections_id, products_id in cur.fetchall():
+                if collections_id in collections and products_id in products:
+                    collections[collections_id].products.append(products[products_id])
+        return list(collections.values())
+
+    def resolve(self, products):
+        "Returns a dict mapping the id of each product a rule matches to a dict of its final attribute values"
+        products_by_id = dict((product.id, product) for product in products)
+        collections = None
+        resolved = {}
+        for kind, matcher, values in self.rules:
+            if kind == 'all':
+                matched = products
+            elif kind == 'collections':
+                if collections is None:
+                    collections = self.__load_collections(products_by_id)
+                matched = dict((product.id, product) for collection in collections if matcher(collection)
+                               for product in collection.products).values()
+            else:
+                matched = [product for product in products if matcher(product)]
+            for product in matched:
+                resolved.setdefault(product.id, {}).update(values)
+        return resolved
+
+    def apply(self, chunk_size=1000, fields=None):
+        """
+        Resolves the rules over the whole catalog and writes the final values that differ from the stored ones,
+        one UPDATE per attribute value. Returns the number of products changed.
+        The catalog is loaded with the attributes, title, vendor and tags only. fields lists any other product fields
+        read by for_products predicates, so they're loaded with it rather than one query per product
+        """
+        products = Product.get_all_products(fields=AttributeRules.attributes + ['title', 'vendor', 'tags'] + list(fields or []))
+        products_by_id = dict((product.id, product) for product in products)
+
+        # Group the products whose value changes by attribute and value
+        updates = {}
+        for products_id, values in self.resolve(products).items():
+            product = products_by_id[products_id]
+            for attribute, value in values.items():
+                if getattr(product, attribute) != value:
+                    updates.setdefault((attribute, value), []).append(products_id)
+
+        changed_ids = set()
+        with DB() as con:
+            cur = con.cursor()
+            for (attribute, value), product_ids in sorted(updates.items()):
+                logging.info('- Setting %s "%s" for %d products' %(attribute, value, len(product_ids)))
+                Product.set_field_for_all(attribute, value, cur, product_ids=product_ids, chunk_size=chunk_size)
+                for products_id in product_ids:
+                    setattr(products_by_id[products_id], attribute, value)
+                    products_by_id[products_id].mark_saved(attribute)
+                changed_ids.update(product_ids)
+            con.commit()
+        print('Attribute rules changed %d products' %(len(changed_ids)))
+        return len(changed_ids)
+
 def import_collections_print_collection_list(collection_list):
     for collection in collection_list:
         print("Title: %s" % (collection['title']))
         for condition in collection['conditions']:
             print("    " + condition)
 
-def clean_sql(sql_str):
-    return sql_str.replace('"','').replace("'","\\'").strip()
-
 def parse_condition_str(condition_str):
     "Helper function to translate condition strs to tuples that can be accepted by collection object"
     # Need to implement greater than, less than
@@ -1522,7 +2954,8 @@ def parse_condition_str(condition_str):
     # get value
     m = re.search('(%s.*%s)(.*)' %(original_variable, original_relation), condition_str)
     if m:
-        value = clean_sql(m.group(2))
+        # Values are passed to the database as parameters, so they only need quotes and whitespace removed
+        value = m.group(2).replace('"','').strip()
 
     # check if everything is set
     if variable and relation and value:
@@ -1530,27 +2963,102 @@ def parse_condition_str(condition_str):
     else:
         raise ValueError('Could not parse condition_str')
 
-def collection_bulk_import(collection_dl):
+def collection_bulk_import(collection_dl, full=False, chunk_size=1000):
     """
     Accepts a list of dicts containing the title of a collection and its conditions,
     and saves it to the database. Products will be updated with urls
+
+    Memberships are updated incrementally. Collections that are new or whose conditions changed are evaluated over
+    the whole catalog, the others only over products that are new or whose title, vendor or tags changed since
+    the last import. full=True evaluates every collection over the whole catalog
     """
+    collections = []
+    titles = []
+    for collection in collection_dl:
+        if collection['title'] not in titles:
+            # Values are passed to the database as parameters, so the title only needs quotes and whitespace removed
+            c = Collection(collection['title'].replace('"','').strip())
+            for condition in collection['conditions']:
+                if not Collection.is_condition(condition):
+                    raise ValueError("Attempted to instantiate collection with malformed condition")
+            c.conditions = list(collection['conditions'])
+            collections.append(c)
+            titles.append(collection['title'])
+        else:
+            logging.info("Duplicate collection, skipping: %s" %(collection['title']))
+
     with DB() as con:
-        collections = []
-        titles = []
-        for collection in collection_dl:
-            if collection['title'] not in titles:
-                c = Collection(clean_sql(collection['title']))
-                c.process_conditions(*collection['conditions'])
-                collections.append(c)
-                titles.append(collection['title'])
-            else:
-                logging.info("Duplicate collection, skipping: %s" %(collection['title']))
+        cur = con.cursor()
+        cur.execute("SELECT collections_handle, collections_id, collections_conditions_fingerprint FROM collections")
+        saved = dict((handle, (collections_id, fingerprint)) for handle, collections_id, fingerprint in cur.fetchall())
+
+    changed_collections = []
+    unchanged_collections = []
+    for collection in collections:
+        if full or saved.get(collection.handle, (None, None))[1] != collection.get_conditions_fingerprint():
+            changed_collections.append(collection)
+        else:
+            collection.id = saved[collection.handle][0]
+            unchanged_collections.append(collection)
+
+    # Evaluate changed collections over the whole catalog, loaded once, and the rest over changed products
+    catalog = []
+    if changed_collections:
+        engine = CollectionRuleEngine()
+        catalog = engine.products
+        for collection in changed_collections:
+            engine.add(collection, *collection.conditions)
+        engine.evaluate()
+    changed_products = catalog if full else Product.get_changed_products(fields=CollectionRuleEngine.fields)
+    changed_ids = [product.id for product in changed_products]
+    if unchanged_collections and changed_products:
+        engine = CollectionRuleEngine(changed_products)
+        for collection in unchanged_collections:
+            engine.add(collection, *collection.conditions)
+        engine.evaluate()
+    logging.info('Collections: %d changed, %d unchanged. Products: %d changed'
+                 %(len(changed_collections), len(unchanged_collections), len(changed_products)))
 
-        for collection in collections:
-            collection.generate_urls(con.cursor())
-            collection.save(con.cursor())
+    with DB() as con:
+        cur = con.cursor()
+        removed_ids = set()
+        for collection in changed_collections:
+            removed_ids.update(collection.save(cur, chunk_size=chunk_size))
+        if changed_ids:
+            for collection in unchanged_collections:
+                removed_ids.update(collection.save_memberships(cur, changed_ids, chunk_size=chunk_size))
+
+        # Urls are recomputed for changed products, products in changed collections, and products that left a collection
+        url_products = dict((product.id, product) for product in catalog)
+        url_products.update((product.id, product) for product in changed_products)
+        affected_ids = set(changed_ids) | removed_ids
+        for collection in changed_collections:
+            affected_ids.update(product.id for product in collection.products)
+        url_products = dict((products_id, url_products[products_id]) for products_id in affected_ids if products_id in url_products)
+
+        # Products in several collections get the url of the last one, as when each collection saved its urls in turn
+        positions = dict((collection.handle, i) for i, collection in enumerate(collections))
+        url_positions = {}
+        product_ids = sorted(url_products)
+        for i in range(0, len(product_ids), chunk_size):
+            chunk = product_ids[i:i + chunk_size]
+            cur.execute("""
+            SELECT pc.products_id, c.collections_handle FROM products_collections AS pc
+            JOIN collections AS c ON c.collections_id = pc.collections_id
+            WHERE pc.products_id IN (%s)
+            """ % (', '.join(['%s'] * len(chunk))), chunk)
+            for products_id, handle in cur.fetchall():
+                if handle in positions and positions[handle] >= url_positions.get(products_id, -1):
+                    url_positions[products_id] = positions[handle]
+        # Products that are in none of the collections have their url cleared
+        for products_id, product in url_products.items():
+            if products_id in url_positions:
+                product.url = collections[url_positions[products_id]].get_product_url(product)
+            else:
+                product.url = ''
+        Product.save_urls(list(url_products.values()), cur)
 
+        Product.mark_evaluated(changed_products, cur)
         con.commit()
 
 def import_collections_from_shopify(*html_files):
@@ -1608,9 +3116,10 @@ def import_collections_from_shopify(*html_files):
 
     #import_collections_print_collection_list(collection_list)
 
-def import_csv_from_shopify(csv_file):
+def import_csv_from_shopify(csv_file, batch_size=None):
     """
-    Imports shopify product CSV from shopify
+    Imports shopify product CSV from shopify. Products are written batch_size rows at a time,
+    defaulting to config.db_write_batch_size
     """
     logging.info('- Importing products from shopify csv: "%s"' %(csv_file.name))
     print('Importing products from shopify csv: "%s"...:' %(csv_file.name))
@@ -1648,10 +3157,7 @@ def import_csv_from_shopify(csv_file):
             else:
                 logging.warn('Skipped %s: malformed Published value'% (row["Handle"]))
 
-        for product in p_list:
-            product.save(con.cursor())
-
-        con.commit()
+        Product.bulk_save(p_list, con, batch_size=batch_size)
 # -- misc functions --
 def get_handle(title):
     return re.sub(r'\s', '-', title.lower()).replace("'","")
@@ -1662,6 +3168,7 @@ def clear_db():
         logging.info('- Wiping Database')
         print("Wiping database...")
         cur = con.cursor()
+        cur.execute('delete from product_tags')
         cur.execute('delete from products')
         cur.execute('delete from collections')
         cur.execute('delete from products_collections')
@@ -1672,7 +3179,7 @@ def process_colors_for_all_products():
     print("Processing colors for all products...",)
     with DB() as con:
         cur = con.cursor()
-        for collection in Collection.get_collections():
+        for collection in Collection.get_collections(fields=['title', 'g_color']):
             for product in collection.products:
                 #print("Processing color for: %s" %(product.title))
                 product.process_g_colors()
@@ -1680,50 +3187,36 @@ def process_colors_for_all_products():
         con.commit()
 
 def set_default_g_age_group(g_age_group):
-    with DB() as con:
-        cur = con.cursor()
-        if g_age_group.lower() in googleDefs.age_group:
-            products = Product.get_all_products()
-            print('Setting default g_age_group for all products to %s...' %(g_age_group))
-            logging.info('- Setting default g_age_group for all products to "%s"' %(g_age_group))
-            for product in products:
-                #print("Saving g_age_group %s for: %s"%(g_age_group, product))
-                product.set_g_age_group(g_age_group)
-                product.save(cur)
-        else:
-            logging.warn('Attempted to set default g_age_group but g_age_group was malformed')
-        con.commit()
+    "Sets g_age_group for every product with a single UPDATE, returns the number of products changed"
+    if g_age_group.lower() in googleDefs.age_group:
+        print('Setting default g_age_group for all products to %s...' %(g_age_group))
+        logging.info('- Setting default g_age_group for all products to "%s"' %(g_age_group))
+        return Product.update_field('g_age_group', g_age_group)
+    else:
+        logging.warn('Attempted to set default g_age_group but g_age_group was malformed')
+        return 0
 
 
 def set_default_g_gender(g_gender):
-    with DB() as con:
-        cur = con.cursor()
-        if g_gender.lower() in googleDefs.gender:
-            products = Product.get_all_products()
-            print('Setting default g_gender for all products to %s...' %(g_gender))
-            logging.info('- Setting default g_gender for all products to "%s"' %(g_gender))
-            for product in products:
-                #print("Saving g_gender %s for %s"%(g_gender, product))
-                product.set_g_gender(g_gender)
-                product.save(cur)
-        else:
-            logging.warn('Attempted to set default g_gender but g_gender was malformed')
-        con.commit()
+    "Sets g_gender for every product with a single UPDATE, returns the number of products changed"
+    if g_gender.lower() in googleDefs.gender:
+        print('Setting default g_gender for all products to %s...' %(g_gender))
+        logging.info('- Setting default g_gender for all products to "%s"' %(g_gender))
+        return Product.update_field('g_gender', g_gender)
+    else:
+        logging.warn('Attempted to set default g_gender but g_gender was malformed')
+        return 0
 
 
 def set_default_g_product_category(g_product_category):
-    with DB() as con:
-        if GoogleFeed.verify_g_product_category(g_product_category):
-            cur = con.cursor()
-            products = Product.get_all_products()
-            print('Setting default g_product_category for all products to %s...' %(g_product_category))
-            logging.info('- Setting default g_product_category for all products to "%s"' %(g_product_category))
-            for product in products:
-                product.set_g_product_category(g_product_category)
-                product.save(cur)
-        else:
-            logging.warn('Attempted to set default g_product_category but g_product_category was malformed.')
-        con.commit()
+    "Sets g_product_category for every product with a single UPDATE, returns the number of products changed"
+    if GoogleFeed.verify_g_product_category(g_product_category):
+        print('Setting default g_product_category for all products to %s...' %(g_product_category))
+        logging.info('- Setting default g_product_category for all products to "%s"' %(g_product_category))
+        return Product.update_field('g_product_category', g_product_category)
+    else:
+        logging.warn('Attempted to set default g_product_category but g_product_category was malformed.')
+        return 0
 # --
 def print_error():
     """
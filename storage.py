@@ -0,0 +1,178 @@
+"""
+Transmission, redistribution or modification of this software is strictly forbidden.
+Copyright 2017, Daniel Newman, All rights reserved.
+"""
+
+"""
+storage.py
+Storage backends for ShopTracker. A backend opens connections to a database and covers the differences
+between SQL dialects, so the rest of ShopTracker can be written once against %s style parameters.
+The backend is selected with db_backend in config.py, either 'mysql' (the default) or 'sqlite'
+"""
+import re
+import sqlite3
+
+try:
+    import MySQLdb as mysql
+    import MySQLdb.cursors
+except ImportError:
+    mysql = None
+
+import config
+
+# Database errors raised by any of the available drivers, for use in except clauses
+if mysql:
+    Error = (mysql.Error, sqlite3.Error)
+else:
+    Error = (sqlite3.Error,)
+
+class MySQLBackend:
+    """
+    Stores data in a MySQL server configured with db_host, db_user, db_password and db_name in config.py
+    """
+    name = 'mysql'
+    insert_ignore = 'INSERT IGNORE'
+
+    def __init__(self):
+        if mysql is None:
+            raise ValueError("db_backend is 'mysql' but mysqlclient isn't installed")
+
+    def connect(self):
+        return mysql.connect(config.db_host, config.db_user, config.db_password, config.db_name)
+
+    def ping(self, con):
+        con.ping()
+
+    def dict_cursor(self, con):
+        "Returns a cursor that fetches rows as dicts keyed by column name"
+        return con.cursor(mysql.cursors.DictCursor)
+
+    def streaming_dict_cursor(self, con):
+        """
+        Returns an unbuffered server side cursor that fetches rows as dicts. Rows are streamed from the server
+        as they're fetched, and no other statement can be run on con until every row has been read
+        """
+        return con.cursor(mysql.cursors.SSDictCursor)
+
+    def upsert_statement(self, table, columns, key_column, id_column, insert_only=()):
+        """
+        Returns a statement inserting a row into table, or updating the row with the same unique key_column.
+        Columns in insert_only are written when the row is inserted and left alone when it's updated.
+        After executing it, upserted_id returns the row's id_column
+        """
+        updates = ['%s = VALUES(%s)' % (column, column) for column in columns if column != key_column and column not in insert_only]
+        updates.append('%s = LAST_INSERT_ID(%s)' % (id_column, id_column))
+        return 'INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s;' % (
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)), ', '.join(updates))
+
+    def upserted_id(self, cur):
+        return cur.lastrowid
+
+class SQLiteCursor:
+    """
+    Wraps a sqlite3 cursor, translating MySQLdb style %s parameters into sqlite's ? parameters.
+    Like MySQLdb, statements are only translated when parameters are given
+    """
+    parameter_regex = re.compile(r'%([s%])')
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def translate(statement):
+        return SQLiteCursor.parameter_regex.sub(lambda m: '?' if m.group(1) == 's' else '%', statement)
+
+    def execute(self, statement, args=None):
+        if args is None:
+            self.cur.execute(statement)
+        else:
+            self.cur.execute(SQLiteCursor.translate(statement), tuple(args))
+        return self.cur.rowcount
+
+    def executemany(self, statement, args):
+        self.cur.executemany(SQLiteCursor.translate(statement), [tuple(row) for row in args])
+        return self.cur.rowcount
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+class SQLiteConnection:
+    "Wraps a sqlite3 connection so its cursors accept MySQLdb style parameters"
+    def __init__(self, con):
+        self.con = con
+
+    def cursor(self):
+        return SQLiteCursor(self.con.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+class SQLiteBackend:
+    """
+    Stores data in an embedded SQLite database at db_path in config.py, run in WAL mode.
+    A db_path of ':memory:' keeps the database in memory, shared by every connection in the process
+    for as long as one of them stays open (the connection pool keeps idle connections open)
+    """
+    name = 'sqlite'
+    insert_ignore = 'INSERT OR IGNORE'
+    # Upserts read the row's id with RETURNING, added in SQLite 3.35
+    minimum_version = (3, 35, 0)
+
+    def __init__(self, path):
+        if sqlite3.sqlite_version_info < SQLiteBackend.minimum_version:
+            raise ValueError("db_backend is 'sqlite' but the linked SQLite library is version %s, ShopTracker requires %s or newer"
+                             %(sqlite3.sqlite_version, '.'.join(str(part) for part in SQLiteBackend.minimum_version)))
+        self.path = path
+
+    def connect(self):
+        if self.path == ':memory:':
+            con = sqlite3.connect('file:shoptracker?mode=memory&cache=shared', uri=True, check_same_thread=False)
+            # Shared cache connections lock tables against each other, let reads see uncommitted rows instead
+            con.execute('PRAGMA read_uncommitted = 1')
+        else:
+            con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            con.execute('PRAGMA journal_mode = WAL')
+            con.execute('PRAGMA synchronous = NORMAL')
+        con.execute('PRAGMA foreign_keys = ON')
+        return SQLiteConnection(con)
+
+    def ping(self, con):
+        con.execute('SELECT 1')
+
+    def __dict_factory(cur, row):
+        return dict((column[0], value) for column, value in zip(cur.description, row))
+
+    def dict_cursor(self, con):
+        "Returns a cursor that fetches rows as dicts keyed by column name"
+        cur = con.cursor()
+        cur.cur.row_factory = SQLiteBackend.__dict_factory
+        return cur
+
+    def streaming_dict_cursor(self, con):
+        "Returns a cursor that fetches rows as dicts. sqlite steps through results as they're fetched, so this is a dict cursor"
+        return self.dict_cursor(con)
+
+    def upsert_statement(self, table, columns, key_column, id_column, insert_only=()):
+        """
+        Returns a statement inserting a row into table, or updating the row with the same unique key_column.
+        Columns in insert_only are written when the row is inserted and left alone when it's updated.
+        After executing it, upserted_id returns the row's id_column
+        """
+        updates = ['%s = excluded.%s' % (column, column) for column in columns if column != key_column and column not in insert_only]
+        return 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s RETURNING %s;' % (
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)), key_column, ', '.join(updates), id_column)
+
+    def upserted_id(self, cur):
+        return cur.fetchone()[0]
+
+def get_backend():
+    "Returns the storage backend configured by db_backend in config.py"
+    backend = getattr(config, 'db_backend', 'mysql')
+    if backend == 'mysql':
+        return MySQLBackend()
+    elif backend == 'sqlite':
+        return SQLiteBackend(getattr(config, 'db_path', 'shoptracker.db'))
+    else:
+        raise ValueError("Unknown db_backend '%s' in config.py, expected 'mysql' or 'sqlite'" %(backend))